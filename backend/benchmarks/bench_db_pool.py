@@ -0,0 +1,66 @@
+"""
+Compare requests/sec of the connect-per-call path against the pooled path.
+
+Run from the backend directory against a running database:
+    python -m benchmarks.bench_db_pool --concurrency 16 --duration 10
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+import db
+from migrations import run_migrations
+from models import NewReceipt
+
+
+async def ensure_receipt() -> int:
+    receipts = await db.list_receipt_records()
+    if receipts:
+        return receipts[0].id
+    receipt = await db.insert_receipt_record(
+        NewReceipt(name="bench", key="bench", data={}, timestamp=datetime.now())
+    )
+    return receipt.id
+
+
+async def run(concurrency: int, duration: float, receipt_id: int) -> float:
+    done = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal done
+        while time.perf_counter() < deadline:
+            await db.get_receipt_record(receipt_id)
+            done += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return done / (time.perf_counter() - start)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    await run_migrations()
+    receipt_id = await ensure_receipt()
+
+    per_call = await run(args.concurrency, args.duration, receipt_id)
+    print(f"connect per call: {per_call:10.1f} req/s")
+
+    await db.open_pool()
+    try:
+        pooled = await run(args.concurrency, args.duration, receipt_id)
+        print(f"pooled:           {pooled:10.1f} req/s")
+        print(f"speedup:          {pooled / per_call:10.2f}x")
+        print("pool stats:", db.get_pool_stats())
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
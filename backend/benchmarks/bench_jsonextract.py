@@ -0,0 +1,155 @@
+"""
+Correctness, fuzzing and speed of jsonextract against the old brace counter.
+
+Run from the backend directory:
+    python -m benchmarks.bench_jsonextract
+    python -m benchmarks.bench_jsonextract --fuzz 20000 --sizes 100,1000,10000
+
+The corpus is benchmarks/llm_corpus/*.txt (expected results in expected.json)
+plus any raw replies saved in llm_responses/texts/ (OCR_SAVE_REPLIES_DIR=llm_responses/texts).
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+from jsonextract import extract_json, JsonExtractError
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "llm_corpus")
+SAVED_RESPONSES = "llm_responses/texts/*.txt"
+
+
+def legacy_llm_resp_to_json(llm_resp):
+    """llm_resp_to_json before jsonextract, kept here for comparison."""
+    curly_brace_count = 0
+    output_json = ""
+    for char in llm_resp:
+        if char == "{":
+            curly_brace_count += 1
+        elif char == "}":
+            curly_brace_count -= 1
+        if curly_brace_count > 0:
+            output_json += char
+
+    output_json = output_json + "}"
+    return json.loads(output_json)
+
+
+def load_corpus() -> dict[str, str]:
+    paths = glob.glob(os.path.join(CORPUS_DIR, "*.txt")) + glob.glob(SAVED_RESPONSES)
+    corpus = {}
+    for path in sorted(paths):
+        with open(path) as f:
+            corpus[path] = f.read()
+    return corpus
+
+
+def parse_or_none(parse, text):
+    try:
+        return parse(text)
+    except (ValueError, RecursionError):
+        return None
+
+
+def check_corpus(corpus: dict[str, str]) -> dict:
+    with open(os.path.join(CORPUS_DIR, "expected.json")) as f:
+        expected = json.load(f)
+
+    report = {"files": len(corpus), "legacy_parsed": 0, "parsed": 0, "mismatches": []}
+    for path, text in corpus.items():
+        if parse_or_none(legacy_llm_resp_to_json, text) is not None:
+            report["legacy_parsed"] += 1
+        result = parse_or_none(extract_json, text)
+        if result is not None:
+            report["parsed"] += 1
+        name = os.path.basename(path)
+        if path.startswith(CORPUS_DIR) and name in expected and result != expected[name]:
+            report["mismatches"].append(name)
+    return report
+
+
+def mutate(text: str, rng: random.Random) -> str:
+    choice = rng.randrange(4)
+    if choice == 0:
+        # truncated at a random point, like a reply that hit max_tokens
+        return text[: rng.randrange(len(text) + 1)]
+    position = rng.randrange(len(text) + 1)
+    if choice == 1:
+        return text[:position] + rng.choice('{}[]",:\'\\`/') + text[position:]
+    if choice == 2:
+        return text[:position] + text[position + rng.randrange(1, 20) :]
+    return text[:position] + "".join(
+        rng.choice('{}[]",:\'\\ \nabc019') for _ in range(rng.randrange(1, 10))
+    ) + text[position:]
+
+
+def fuzz(corpus: dict[str, str], iterations: int, seed: int) -> dict:
+    """extract_json must return a value or raise JsonExtractError, never anything else."""
+    rng = random.Random(seed)
+    texts = [t for t in corpus.values() if t]
+    parsed = 0
+    for _ in range(iterations):
+        text = mutate(rng.choice(texts), rng)
+        try:
+            extract_json(text)
+            parsed += 1
+        except JsonExtractError:
+            pass
+        except Exception as e:
+            raise AssertionError(f"{type(e).__name__} on input {text!r}") from e
+    return {"iterations": iterations, "parsed": parsed}
+
+
+def large_reply(items: int, truncated: bool) -> str:
+    item = '{"name": "Item {x}", "quantity": 1, "price": 1.25, "category": "Produce"}'
+    text = '```json\n{"store_name": "Big Store", "items": [' + ", ".join([item] * items) + "]}\n```"
+    # cutting inside the last item forces the repair path
+    return text[: -len(item) // 2] if truncated else text
+
+
+def time_call(parse, text: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse_or_none(parse, text)
+        best = min(best, time.perf_counter() - start)
+    return round(best * 1000, 3)
+
+
+def timings(sizes: list[int], repeat: int) -> dict:
+    report = {}
+    for size in sizes:
+        report[size] = {}
+        for truncated in (False, True):
+            text = large_reply(size, truncated)
+            label = "truncated" if truncated else "complete"
+            report[size][label] = {
+                "bytes": len(text),
+                "legacy_ms": time_call(legacy_llm_resp_to_json, text, repeat),
+                "extract_ms": time_call(extract_json, text, repeat),
+            }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fuzz", type=int, default=5000, help="mutated inputs to try")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="item counts to time")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    report = {
+        "corpus": check_corpus(corpus),
+        "fuzz": fuzz(corpus, args.fuzz, args.seed),
+        "timings": timings([int(s) for s in args.sizes.split(",")], args.repeat),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Latency of GET /receipts style queries on a large receipts table.
+
+Seeds synthetic receipts with COPY, then times first pages, deep keyset
+pages, filtered pages and the summary projection. Run from the backend
+directory against a throwaway database:
+    python -m benchmarks.bench_list_receipts --seed 1000000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import psycopg
+
+import db
+from migrations import run_migrations
+
+STORES = ["Publix", "Trader Joe's", "Whole Foods", "Costco", "Main Street Restaurant"]
+
+
+def fake_receipt_data(rng: random.Random) -> dict:
+    items = [
+        {
+            "name": f"Item {rng.randrange(5000)}",
+            "quantity": rng.randint(1, 4),
+            "price": round(rng.uniform(0.5, 30), 2),
+            "category": rng.choice(["Produce", "Dairy", "Meat", "Bakery", "Pantry"]),
+        }
+        for _ in range(rng.randint(3, 30))
+    ]
+    return {
+        "date": "07-04-2017",
+        "total_amount": round(sum(i["price"] * i["quantity"] for i in items), 2),
+        "items": items,
+        "store_name": rng.choice(STORES),
+    }
+
+
+async def seed(rows: int):
+    rng = random.Random(0)
+    start = datetime(2020, 1, 1)
+    async with await psycopg.AsyncConnection.connect(db.connection_string) as conn:
+        async with conn.cursor() as cur:
+            async with cur.copy(
+                "COPY receipts (name, key, data, datetime, status) FROM STDIN"
+            ) as copy:
+                for i in range(rows):
+                    await copy.write_row(
+                        (
+                            f"receipt {i}",
+                            f"{rng.getrandbits(128):032x}",
+                            json.dumps(fake_receipt_data(rng)),
+                            start + timedelta(minutes=i),
+                            "done",
+                        )
+                    )
+            await cur.execute("ANALYZE receipts")
+
+
+async def timed(label: str, repeat: int, make_call):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = await make_call()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print(
+        f"{label:32} p50 {timings[len(timings) // 2]:8.2f} ms"
+        f"  max {timings[-1]:8.2f} ms  rows {len(result)}"
+    )
+    return result
+
+
+async def deep_page(pages: int, limit: int):
+    cursor = None
+    for _ in range(pages):
+        receipts = await db.list_receipt_records(limit=limit, cursor=cursor)
+        cursor = db.encode_cursor(receipts[-1])
+    return receipts
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0, help="rows to insert first")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--full-scan", action="store_true", help="also time the old unpaginated list"
+    )
+    args = parser.parse_args()
+
+    await run_migrations()
+    if args.seed:
+        start = time.perf_counter()
+        await seed(args.seed)
+        print(f"seeded {args.seed} rows in {time.perf_counter() - start:.1f}s")
+
+    await db.open_pool()
+    try:
+        limit = args.limit
+        await timed("first page", args.repeat, lambda: db.list_receipt_records(limit=limit))
+        await timed(
+            "first page, summary",
+            args.repeat,
+            lambda: db.list_receipt_records(limit=limit, fields="summary"),
+        )
+        await timed("page 50 via cursor", 1, lambda: deep_page(50, limit))
+        await timed(
+            "store filter",
+            args.repeat,
+            lambda: db.list_receipt_records(limit=limit, store="costco"),
+        )
+        await timed(
+            "date range",
+            args.repeat,
+            lambda: db.list_receipt_records(
+                limit=limit, since=datetime(2020, 2, 1), until=datetime(2020, 3, 1)
+            ),
+        )
+        await timed(
+            "name prefix",
+            args.repeat,
+            lambda: db.list_receipt_records(limit=limit, name="receipt 4242"),
+        )
+        if args.full_scan:
+            await timed("everything (old behaviour)", 1, db.list_receipt_records)
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""
+Payload size and encode time of the OCR image before and after preprocessing.
+
+Run from the backend directory:
+    python -m benchmarks.bench_preprocess            # local only
+    python -m benchmarks.bench_preprocess --ocr      # also time real OCR calls
+
+--ocr needs GROQ_API_KEY and sends every sample twice (original and preprocessed).
+"""
+
+import argparse
+import base64
+import glob
+import json
+import time
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+
+import extraction
+from imagepreprocess import preprocess_for_ocr, encode_for_ocr
+
+SAMPLE_PATTERNS = ["../*.jpg", "../*.jpeg", "*.jpg", "*.jpeg"]
+
+
+def encode_original(pil_img) -> str:
+    """What encode_image sent before preprocessing: the full image as JPEG."""
+    buffered = BytesIO()
+    pil_img.convert("RGB").save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def encode_preprocessed(pil_img) -> str:
+    img_bytes = encode_for_ocr(preprocess_for_ocr(pil_img))
+    return base64.b64encode(img_bytes).decode("utf-8")
+
+
+def measure(path: str, encode, ocr: bool) -> dict:
+    # not loaded up front, like get_receipt_json, so decode time is included
+    with Image.open(path) as img:
+        start = time.perf_counter()
+        payload = encode(img)
+        encode_ms = (time.perf_counter() - start) * 1000
+        result = {"payload_bytes": len(payload), "encode_ms": round(encode_ms, 1)}
+
+        if ocr:
+            with mock.patch.object(
+                extraction, "encode_image", lambda _img: payload
+            ):
+                start = time.perf_counter()
+                extraction.GroqVisionBackend().ocr_reciept(img)
+                result["ocr_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ocr", action="store_true")
+    parser.add_argument("images", nargs="*")
+    args = parser.parse_args()
+
+    paths = args.images or sorted(
+        {p for pattern in SAMPLE_PATTERNS for p in glob.glob(pattern)}
+    )
+    report = {}
+    for path in paths:
+        before = measure(path, encode_original, args.ocr)
+        after = measure(path, encode_preprocessed, args.ocr)
+        report[path] = {
+            "before": before,
+            "after": after,
+            "payload_ratio": round(after["payload_bytes"] / before["payload_bytes"], 3),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
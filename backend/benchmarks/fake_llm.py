@@ -0,0 +1,169 @@
+"""
+A local stand-in for the Groq chat completions API.
+
+Answers after a configurable latency, fails a configurable share of requests
+with 429 / 503, and supports streaming. Replies are canned: receipt JSON for
+requests with an image (a share of them with fields that fail validation), a
+fix for every field of an OCR repair request, a recipe list when the prompt
+asks for recipes, and a <think> block followed by text otherwise.
+
+Run from the backend directory and point the app at it:
+    python -m benchmarks.fake_llm --port 8001 --latency 0.5 --failure-rate 0.1
+    LLM_BASE_URL=http://127.0.0.1:8001 uvicorn main:app
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+RECEIPT = {
+    "date": "07-04-2024",
+    "total_amount": 12.5,
+    "items": [
+        {"name": "Spinach", "quantity": 1, "price": 3.5, "category": "Produce", "is_heathly": True},
+        {"name": "Milk", "quantity": 1, "price": 4.0, "category": "Dairy", "is_heathly": True},
+        {"name": "Chips", "quantity": 1, "price": 5.0, "category": "Snacks", "is_heathly": False},
+    ],
+    "tax": 0.0,
+    "store_name": "Fake Mart",
+    "store_type": "Grocery",
+}
+
+RECIPES = {
+    "recipes": [
+        {"name": "Spinach Omelette", "ingredients": ["spinach", "eggs", "milk"]},
+        {"name": "Creamed Spinach", "ingredients": ["spinach", "milk", "butter"]},
+    ]
+}
+
+# what a model sometimes writes instead of the requested types
+INVALID_RECEIPT = {
+    **RECEIPT,
+    "date": "the fifth of july",
+    "total_amount": "twelve fifty",
+    "items": [{**RECEIPT["items"][0], "price": "three fifty"}, *RECEIPT["items"][1:]],
+}
+
+DETAILS = "<think>\nThe user wants a recipe.\n</think>\n\n## Steps\n1. Prepare the ingredients.\n2. Cook them.\n"
+
+config = argparse.Namespace(
+    latency=0.5, jitter=0.2, failure_rate=0.0, invalid_rate=0.0, chunk_delay=0.02
+)
+app = FastAPI()
+# served requests by kind, for load test reports
+counts = {"ocr": 0, "repair": 0, "recipes": 0, "details": 0, "failed": 0}
+
+
+def reply_for(messages: list) -> str:
+    content = messages[-1]["content"]
+    parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+    if any(part.get("type") == "image_url" for part in parts):
+        counts["ocr"] += 1
+        return json.dumps(INVALID_RECEIPT if random.random() < config.invalid_rate else RECEIPT)
+    text = " ".join(part.get("text", "") for part in parts)
+    if "Fields:" in text:
+        counts["repair"] += 1
+        fields = json.loads(text[text.index("Fields:") + len("Fields:") :])
+        return json.dumps({name: repaired_value(name) for name in fields})
+    if "recipes" in text:
+        counts["recipes"] += 1
+        return json.dumps(RECIPES)
+    counts["details"] += 1
+    return DETAILS
+
+
+def repaired_value(field: str):
+    name = field.rsplit(".", 1)[-1]
+    if name == "date":
+        return "05-07-2024"
+    if name in ("total_amount", "price", "quantity", "tax", "tip"):
+        return 3.5
+    if name.startswith("is_"):
+        return False
+    return None
+
+
+def chunk_body(completion_id: str, model: str, delta: dict, finish_reason=None) -> str:
+    body = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(body)}\n\n"
+
+
+async def stream_reply(completion_id: str, model: str, reply: str):
+    yield chunk_body(completion_id, model, {"role": "assistant", "content": ""})
+    for i in range(0, len(reply), 8):
+        await asyncio.sleep(config.chunk_delay)
+        yield chunk_body(completion_id, model, {"content": reply[i : i + 8]})
+    yield chunk_body(completion_id, model, {}, "stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+    if random.random() < config.failure_rate:
+        status = random.choice([429, 503])
+        counts["failed"] += 1
+        return JSONResponse(
+            status_code=status,
+            content={"error": {"message": "fake failure", "type": "fake_error"}},
+            headers={"retry-after": "0.1"} if status == 429 else None,
+        )
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body["model"]
+    reply = reply_for(body["messages"])
+    if body.get("stream"):
+        return StreamingResponse(
+            stream_reply(completion_id, model, reply), media_type="text/event-stream"
+        )
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 100, "completion_tokens": len(reply) // 4, "total_tokens": 100 + len(reply) // 4},
+    }
+
+
+@app.get("/stats")
+def stats():
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=config.latency, help="seconds before answering")
+    parser.add_argument("--jitter", type=float, default=config.jitter)
+    parser.add_argument("--failure-rate", type=float, default=config.failure_rate)
+    parser.add_argument("--invalid-rate", type=float, default=config.invalid_rate, help="share of OCR replies with invalid fields")
+    parser.add_argument("--chunk-delay", type=float, default=config.chunk_delay)
+    args = parser.parse_args()
+    for name in ("latency", "jitter", "failure_rate", "invalid_rate", "chunk_delay"):
+        setattr(config, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+A local stand-in for the Google Places Nearby Search API.
+
+Answers after a configurable latency with up to three pages of 20 generated
+places around the requested location. Like Google, a next_page_token is
+rejected with INVALID_REQUEST until --token-delay seconds after it was issued.
+
+Run from the backend directory and point the app at it:
+    python -m benchmarks.fake_places --port 8002 --latency 0.3
+    PLACES_BASE_URL=http://127.0.0.1:8002 uvicorn main:app
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+import uvicorn
+from fastapi import FastAPI
+
+config = argparse.Namespace(latency=0.3, jitter=0.1, token_delay=2.0, pages=3, page_size=20)
+app = FastAPI()
+requests_served = 0
+# token -> (time it becomes valid, location, page number)
+page_tokens: dict[str, tuple[float, str, int]] = {}
+
+
+def places_page(location: str, page: int) -> list[dict]:
+    lat, lng = (float(x) for x in location.split(","))
+    rng = random.Random(f"{location}:{page}")
+    return [
+        {
+            "place_id": f"fake-{uuid.UUID(int=rng.getrandbits(128)).hex}",
+            "name": f"Fake Market {page * config.page_size + i + 1}",
+            "geometry": {
+                "location": {
+                    "lat": lat + rng.uniform(-0.01, 0.01),
+                    "lng": lng + rng.uniform(-0.01, 0.01),
+                }
+            },
+            "vicinity": f"{rng.randrange(1, 999)} Fake Street",
+            "rating": round(rng.uniform(3, 5), 1),
+            "types": ["grocery_or_supermarket", "food", "point_of_interest"],
+        }
+        for i in range(config.page_size)
+    ]
+
+
+def page_body(location: str, page: int) -> dict:
+    body = {"status": "OK", "html_attributions": [], "results": places_page(location, page)}
+    if page + 1 < config.pages:
+        token = uuid.uuid4().hex
+        page_tokens[token] = (time.monotonic() + config.token_delay, location, page + 1)
+        body["next_page_token"] = token
+    return body
+
+
+@app.get("/maps/api/place/nearbysearch/json")
+async def nearby_search(
+    key: str = "",
+    location: str | None = None,
+    radius: int | None = None,
+    type: str | None = None,
+    keyword: str | None = None,
+    pagetoken: str | None = None,
+):
+    global requests_served
+    requests_served += 1
+    await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+    if pagetoken is not None:
+        if pagetoken not in page_tokens or page_tokens[pagetoken][0] > time.monotonic():
+            return {"status": "INVALID_REQUEST", "html_attributions": [], "results": []}
+        _, location, page = page_tokens[pagetoken]
+        return page_body(location, page)
+    if location is None or radius is None:
+        return {"status": "INVALID_REQUEST", "html_attributions": [], "results": []}
+    return page_body(location, 0)
+
+
+@app.get("/stats")
+def stats():
+    return {"requests": requests_served}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=float, default=config.latency, help="seconds before answering")
+    parser.add_argument("--jitter", type=float, default=config.jitter)
+    parser.add_argument("--token-delay", type=float, default=config.token_delay, help="seconds before a page token works")
+    parser.add_argument("--pages", type=int, default=config.pages)
+    args = parser.parse_args()
+    for name in ("latency", "jitter", "token_delay", "pages"):
+        setattr(config, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+A local stand-in for the Shutterstock image search API.
+
+Answers after a configurable latency with generated images for the query, and
+fails a configurable share of requests with 429 / 503 (or all of them, to
+watch the circuit breaker open).
+
+Run from the backend directory and point the app at it:
+    python -m benchmarks.fake_shutterstock --port 8003 --failure-rate 0.2
+    SHUTTERSTOCK_BASE_URL=http://127.0.0.1:8003 SHUTTERSTOCK_API_KEY=fake SHUTTERSTOCK_API_SECRET=fake uvicorn main:app
+"""
+
+import argparse
+import asyncio
+import random
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+config = argparse.Namespace(latency=0.3, jitter=0.1, failure_rate=0.0)
+app = FastAPI()
+requests_served = 0
+
+
+def image(query: str, i: int) -> dict:
+    slug = "-".join(query.split())
+    assets = {
+        name: {"url": f"https://images.example.com/{name}/{slug}-{i}.jpg", "width": width}
+        for name, width in [("small_thumb", 100), ("preview", 450), ("preview_1000", 1000)]
+    }
+    return {"id": f"{abs(hash(slug)) % 10**10}{i}", "description": f"{query} {i}", "assets": assets}
+
+
+@app.get("/v2/images/search")
+async def images_search(query: str = "", per_page: int = 20, page: int = 1):
+    global requests_served
+    requests_served += 1
+    await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+    if random.random() < config.failure_rate:
+        status = random.choice([429, 503])
+        return JSONResponse(
+            status_code=status,
+            content={"message": "fake failure"},
+            headers={"retry-after": "0.1"} if status == 429 else None,
+        )
+    return {
+        "page": page,
+        "per_page": per_page,
+        "total_count": per_page,
+        "data": [image(query, i) for i in range(per_page)],
+    }
+
+
+@app.get("/stats")
+def stats():
+    return {"requests": requests_served}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8003)
+    parser.add_argument("--latency", type=float, default=config.latency, help="seconds before answering")
+    parser.add_argument("--jitter", type=float, default=config.jitter)
+    parser.add_argument("--failure-rate", type=float, default=config.failure_rate)
+    args = parser.parse_args()
+    for name in ("latency", "jitter", "failure_rate"):
+        setattr(config, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Lenient conversion of values the LLM wrote into the types receipts are stored with."""
+
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+# tried in order, day-first like the DD-MM-YYYY the OCR prompt asks for
+RECEIPT_DATE_FORMATS = [
+    "%d-%m-%Y",
+    "%d/%m/%Y",
+    "%d.%m.%Y",
+    "%Y-%m-%d",
+    "%Y/%m/%d",
+    "%d%m%Y",
+    "%d-%m-%y",
+    "%d/%m/%y",
+    "%d %b %Y",
+    "%d %B %Y",
+    "%b %d, %Y",
+    "%B %d, %Y",
+    "%b %d %Y",
+    "%B %d %Y",
+]
+RECEIPT_DATE_FORMAT = "%d-%m-%Y"
+
+
+def to_number(value) -> Decimal | None:
+    """Lenient number parsing for LLM output ("$2.50", "1,299.00", 3)."""
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        number = Decimal(str(value).replace("$", "").replace(",", "").strip())
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+
+def to_bool(value) -> bool | None:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ("true", "yes"):
+        return True
+    if isinstance(value, str) and value.strip().lower() in ("false", "no"):
+        return False
+    return None
+
+
+def to_text(value) -> str | None:
+    if value is None or value == "":
+        return None
+    return str(value)
+
+
+def to_date(value) -> date | None:
+    """A receipt date in any of RECEIPT_DATE_FORMATS (ISO timestamps too)."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    for format in RECEIPT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, format).date()
+        except ValueError:
+            pass
+    try:
+        return datetime.fromisoformat(text).date()
+    except ValueError:
+        return None
+
+
+def is_blank(value) -> bool:
+    return value is None or (isinstance(value, str) and value.strip() == "")
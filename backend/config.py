@@ -0,0 +1,38 @@
+"""
+Shared settings, read from the environment after loading .env once.
+
+Entry points (main.py, the CLIs) import this module first, so modules that read
+os.environ at import time also see the values from .env.
+"""
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# receipt extraction backend: groq (vision LLM), tesseract (local OCR), tiered (local OCR,
+# the vision LLM only for receipts it cannot read confidently) or stub (canned result)
+OCR_BACKEND = os.environ.get("OCR_BACKEND", "groq")
+OCR_MODEL = os.environ.get("OCR_MODEL", "llama-3.2-90b-vision-preview")
+# ask for a JSON object reply (the provider's JSON mode) instead of free-form text
+OCR_JSON_MODE = os.environ.get("OCR_JSON_MODE", "1") == "1"
+# fix fields failing validation with a text-only LLM call (LLM backends only)
+OCR_REPAIR = os.environ.get("OCR_REPAIR", "1") == "1"
+# much cheaper than re-sending the image
+OCR_REPAIR_MODEL = os.environ.get("OCR_REPAIR_MODEL", "llama-3.1-8b-instant")
+# max number of receipts decoded and extracted at the same time
+OCR_CONCURRENCY = int(os.environ.get("OCR_CONCURRENCY", "4"))
+# JSON file returned by the stub backend, a built-in sample receipt when unset
+OCR_STUB_RESPONSE = os.environ.get("OCR_STUB_RESPONSE") or None
+OCR_TESSERACT_LANG = os.environ.get("OCR_TESSERACT_LANG", "eng")
+# when set, raw vision LLM replies are written here (e.g. llm_responses/texts)
+OCR_SAVE_REPLIES_DIR = os.environ.get("OCR_SAVE_REPLIES_DIR") or None
+# tiered: local results are kept only when the mean word confidence (0-100) reaches this
+OCR_LOCAL_MIN_CONFIDENCE = float(os.environ.get("OCR_LOCAL_MIN_CONFIDENCE", "80"))
+# tiered: relative tolerance when checking the items add up to the subtotal / total
+OCR_CHECKSUM_TOLERANCE = float(os.environ.get("OCR_CHECKSUM_TOLERANCE", "0.01"))
+# price of one vision LLM call, for the savings reported by GET /stats
+OCR_LLM_CALL_COST = float(os.environ.get("OCR_LLM_CALL_COST", "0"))
+# run migrations and requeue interrupted OCR jobs when the app starts; serve.py does both
+# once before starting its worker processes and turns this off for them
+STARTUP_MIGRATIONS = os.environ.get("STARTUP_MIGRATIONS", "1") == "1"
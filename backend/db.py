@@ -1,70 +1,578 @@
+import os
 import psycopg
-from models import NewReceipt, Receipt
+from psycopg_pool import AsyncConnectionPool
+from models import (
+    NewReceipt,
+    Receipt,
+    ReceiptStatus,
+    PeriodSpend,
+    CategorySpend,
+)
 import json
+import base64
+from datetime import date, datetime
+from coercion import to_number, to_bool, to_text
 
 # connection_string = "dbname=payperless user=postgres password=postgres host=localhost"
-connection_string = "dbname=receiptscanner user=receiptscanner password=oijasLODIUjliusandhliuhadsi host=localhost"
+connection_string = os.environ.get(
+    "DATABASE_URL",
+    "dbname=receiptscanner user=receiptscanner password=oijasLODIUjliusandhliuhadsi host=localhost",
+)
+
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+# seconds a connection above min_size may sit unused before it is closed
+POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
+# seconds a request waits for a free connection before failing
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+
+pool: AsyncConnectionPool | None = None
+
+
+async def open_pool():
+    global pool
+    if pool is not None:
+        return
+    pool = AsyncConnectionPool(
+        connection_string,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        max_idle=POOL_MAX_IDLE,
+        timeout=POOL_TIMEOUT,
+        # health check run on every checkout, broken connections are replaced
+        check=AsyncConnectionPool.check_connection,
+        name="receipts",
+        open=False,
+    )
+    await pool.open(wait=True)
+
+
+async def close_pool():
+    global pool
+    if pool is None:
+        return
+    await pool.close()
+    pool = None
+
+
+def get_pool_stats() -> dict:
+    """Wait/usage counters of the pool (empty when running without one)."""
+    if pool is None:
+        return {}
+    return pool.get_stats()
 
 
 def db_connection(func):
-    def wrapper(*args, **kwargs):
-        with psycopg.connect(connection_string) as conn:
-            with conn.cursor() as cur:
-                return func(conn, cur, *args, **kwargs)
+    async def wrapper(*args, **kwargs):
+        if pool is None:
+            # scripts and one-off calls outside the app: connect per call
+            async with await psycopg.AsyncConnection.connect(connection_string) as conn:
+                async with conn.cursor() as cur:
+                    return await func(conn, cur, *args, **kwargs)
+
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                return await func(conn, cur, *args, **kwargs)
 
     return wrapper
 
 
+RECEIPT_COLUMNS = (
+    "id, name, key, data, datetime, status, image_hash, content_type"
+)
+# same shape as RECEIPT_COLUMNS, with data cut down to what list views show
+RECEIPT_SUMMARY_COLUMNS = (
+    "id, name, key, "
+    "json_build_object('store_name', data->'store_name', 'date', data->'date', "
+    "'total_amount', data->'total_amount'), "
+    "datetime, status, image_hash, content_type"
+)
+
+
 def tuple_to_receipt(t) -> Receipt:
-    (_id, name, key, data, timestamp) = t
+    (_id, name, key, data, timestamp, status, image_hash, content_type) = t
     return Receipt(
-        id=_id, name=name, key=key, data=data, timestamp=timestamp.isoformat()
+        id=_id,
+        name=name,
+        key=key,
+        data=data,
+        timestamp=timestamp.isoformat(),
+        status=status,
+        image_hash=image_hash,
+        content_type=content_type,
+    )
+
+
+def new_receipt_params(receipt: NewReceipt) -> tuple:
+    return (
+        receipt.name,
+        receipt.key,
+        json.dumps(receipt.data),
+        receipt.timestamp,
+        receipt.status,
+        receipt.image_hash,
+        receipt.content_type,
+    )
+
+
+def json_number_sql(expr: str) -> str:
+    """SQL for a text JSON value as NUMERIC with the same leniency as to_number."""
+    cleaned = f"regexp_replace({expr}, '[$,[:space:]]', '', 'g')"
+    return f"CASE WHEN {cleaned} ~ '^-?[0-9]+(\\.[0-9]+)?$' THEN {cleaned}::numeric END"
+
+
+def json_bool_sql(expr: str) -> str:
+    """SQL for a JSONB value as BOOLEAN, NULL unless it is a JSON boolean."""
+    return f"CASE WHEN jsonb_typeof({expr}) = 'boolean' THEN ({expr})::text::boolean END"
+
+
+RECEIPT_TOTAL_SQL = json_number_sql("data->>'total_amount'")
+# month a receipt's spending counts in: the purchase date read by OCR, or the
+# upload time when there is none (SQL function from migration 10)
+RECEIPT_PERIOD_SQL = "receipt_period(r.data, r.datetime)"
+
+
+def receipt_item_rows(receipt_id: int, data) -> list[tuple]:
+    """Rows for receipt_items from the items[] of an OCR result."""
+    items = data.get("items") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return []
+    rows = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        rows.append(
+            (
+                receipt_id,
+                position,
+                to_text(item.get("name")),
+                to_number(item.get("quantity")),
+                to_number(item.get("price")),
+                to_text(item.get("category")),
+                to_text(item.get("sub_category")),
+                # the OCR prompt spells it is_heathly
+                to_bool(item.get("is_healthy", item.get("is_heathly"))),
+                to_bool(item.get("is_organic")),
+                to_bool(item.get("is_local")),
+                to_bool(item.get("is_sustainable")),
+            )
+        )
+    return rows
+
+
+async def replace_receipt_items(cur, receipt_id: int, data):
+    """Re-project a receipt's items, runs inside the caller's transaction."""
+    await cur.execute("DELETE FROM receipt_items WHERE receipt_id = %s", (receipt_id,))
+    rows = receipt_item_rows(receipt_id, data)
+    if rows:
+        await cur.executemany(
+            "INSERT INTO receipt_items (receipt_id, position, name, quantity, price, category, sub_category, is_healthy, is_organic, is_local, is_sustainable) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            rows,
+        )
+
+
+async def apply_spending_aggregates(cur, receipt_id: int, sign: int):
+    """
+    Add (sign=1) or remove (sign=-1) a done receipt's contribution to the
+    spending aggregates, runs inside the caller's transaction.
+
+    The month comes from the receipt's current data, so removing before an
+    update and adding after it moves the receipt when OCR changes its date.
+    """
+    await cur.execute(
+        f"""
+        INSERT INTO spending_by_period (period, receipt_count, total_spend)
+        SELECT {RECEIPT_PERIOD_SQL}, %(sign)s, %(sign)s * COALESCE({RECEIPT_TOTAL_SQL}, 0)
+        FROM receipts r
+        WHERE r.id = %(receipt_id)s AND r.status = 'done'
+        ON CONFLICT (period) DO UPDATE SET
+            receipt_count = spending_by_period.receipt_count + EXCLUDED.receipt_count,
+            total_spend = spending_by_period.total_spend + EXCLUDED.total_spend
+        """,
+        {"sign": sign, "receipt_id": receipt_id},
+    )
+    await cur.execute(
+        f"""
+        INSERT INTO spending_by_category (period, category, item_count, spend, healthy_spend, organic_spend, local_spend, sustainable_spend)
+        SELECT
+            {RECEIPT_PERIOD_SQL},
+            COALESCE(lower(i.category), ''),
+            %(sign)s * count(*),
+            %(sign)s * COALESCE(sum(i.price), 0),
+            %(sign)s * COALESCE(sum(i.price) FILTER (WHERE i.is_healthy), 0),
+            %(sign)s * COALESCE(sum(i.price) FILTER (WHERE i.is_organic), 0),
+            %(sign)s * COALESCE(sum(i.price) FILTER (WHERE i.is_local), 0),
+            %(sign)s * COALESCE(sum(i.price) FILTER (WHERE i.is_sustainable), 0)
+        FROM receipt_items i
+        JOIN receipts r ON r.id = i.receipt_id
+        WHERE i.receipt_id = %(receipt_id)s AND r.status = 'done'
+        GROUP BY 1, 2
+        ON CONFLICT (period, category) DO UPDATE SET
+            item_count = spending_by_category.item_count + EXCLUDED.item_count,
+            spend = spending_by_category.spend + EXCLUDED.spend,
+            healthy_spend = spending_by_category.healthy_spend + EXCLUDED.healthy_spend,
+            organic_spend = spending_by_category.organic_spend + EXCLUDED.organic_spend,
+            local_spend = spending_by_category.local_spend + EXCLUDED.local_spend,
+            sustainable_spend = spending_by_category.sustainable_spend + EXCLUDED.sustainable_spend
+        """,
+        {"sign": sign, "receipt_id": receipt_id},
+    )
+    if sign < 0:
+        # a month the receipt moved out of may have nothing left in it
+        await cur.execute("DELETE FROM spending_by_period WHERE receipt_count = 0")
+        await cur.execute("DELETE FROM spending_by_category WHERE item_count = 0")
+
+
+@db_connection
+async def get_spending_by_period(conn, cur, since: date) -> list[PeriodSpend]:
+    await cur.execute(
+        "SELECT period, receipt_count, total_spend FROM spending_by_period WHERE period >= %s ORDER BY period DESC",
+        (since,),
+    )
+    return [
+        PeriodSpend(period=period, receipt_count=count, total_spend=total)
+        for period, count, total in await cur.fetchall()
+    ]
+
+
+@db_connection
+async def get_spending_by_category(
+    conn, cur, since: date
+) -> list[CategorySpend]:
+    await cur.execute(
+        """
+        SELECT category, sum(item_count), sum(spend), sum(healthy_spend),
+            sum(organic_spend), sum(local_spend), sum(sustainable_spend)
+        FROM spending_by_category
+        WHERE period >= %s
+        GROUP BY category
+        ORDER BY sum(spend) DESC
+        """,
+        (since,),
+    )
+    return [
+        CategorySpend(
+            category=category,
+            item_count=item_count,
+            spend=spend,
+            healthy_spend=healthy,
+            organic_spend=organic,
+            local_spend=local,
+            sustainable_spend=sustainable,
+        )
+        for category, item_count, spend, healthy, organic, local, sustainable in await cur.fetchall()
+    ]
+
+
+@db_connection
+async def list_recent_ingredients(
+    conn, cur, since: datetime, category_patterns: list[str] | None, limit: int
+) -> list[str]:
+    """
+    Distinct lower-cased item names bought since `since`, most recently bought first.
+
+    With category_patterns only items whose category matches one of the LIKE
+    patterns are returned.
+    """
+    await cur.execute(
+        """
+        SELECT lower(trim(i.name))
+        FROM receipt_items i
+        JOIN receipts r ON r.id = i.receipt_id
+        WHERE r.status = 'done' AND r.datetime >= %(since)s
+            AND trim(i.name) <> ''
+            AND (%(patterns)s::text[] IS NULL OR lower(i.category) LIKE ANY(%(patterns)s::text[]))
+        GROUP BY 1
+        ORDER BY max(r.datetime) DESC, 1
+        LIMIT %(limit)s
+        """,
+        {"since": since, "patterns": category_patterns, "limit": limit},
+    )
+    return [name for (name,) in await cur.fetchall()]
+
+
+@db_connection
+async def get_recipe_suggestion_record(conn, cur, fingerprint: str) -> dict | None:
+    await cur.execute(
+        "SELECT recipes FROM recipe_suggestions WHERE fingerprint = %s", (fingerprint,)
+    )
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+@db_connection
+async def get_latest_recipe_suggestion_record(conn, cur) -> tuple[str, dict] | None:
+    """(fingerprint, recipes) of the most recently generated suggestions."""
+    await cur.execute(
+        "SELECT fingerprint, recipes FROM recipe_suggestions ORDER BY created_at DESC LIMIT 1"
     )
+    return await cur.fetchone()
 
 
 @db_connection
-def create_receipt_table(conn, cur):
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS receipts (
-            id SERIAL PRIMARY KEY,
-            name VARCHAR(100),
-            key VARCHAR(100),
-            data JSON,
-            datetime TIMESTAMP
-        )""")
+async def save_recipe_suggestion_record(
+    conn, cur, fingerprint: str, ingredients: list[str], recipes: dict, keep: int
+):
+    """Store suggestions for an ingredient set, keeping only the newest `keep` sets."""
+    await cur.execute(
+        """
+        INSERT INTO recipe_suggestions (fingerprint, ingredients, recipes)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (fingerprint) DO UPDATE SET
+            ingredients = EXCLUDED.ingredients,
+            recipes = EXCLUDED.recipes,
+            created_at = now()
+        """,
+        (fingerprint, json.dumps(ingredients), json.dumps(recipes)),
+    )
+    await cur.execute(
+        """
+        DELETE FROM recipe_suggestions WHERE fingerprint IN (
+            SELECT fingerprint FROM recipe_suggestions ORDER BY created_at DESC OFFSET %s
+        )""",
+        (keep,),
+    )
+    await conn.commit()
 
 
 @db_connection
-def insert_receipt_record(conn, cur, receipt: NewReceipt) -> Receipt:
-    cur.execute(
-        "INSERT INTO receipts (name, key, data, datetime) VALUES (%s, %s, %s, %s) RETURNING id, name, key, data, datetime",
-        (
-            receipt.name,
-            receipt.key,
-            json.dumps(receipt.data),
-            receipt.timestamp,
-        ),
+async def insert_receipt_record(conn, cur, receipt: NewReceipt) -> Receipt:
+    await cur.execute(
+        f"INSERT INTO receipts (name, key, data, datetime, status, image_hash, content_type) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING {RECEIPT_COLUMNS}",
+        new_receipt_params(receipt),
     )
-    inserted_receipt = cur.fetchone()
-    conn.commit()
+    inserted_receipt = await cur.fetchone()
+    await conn.commit()
 
     return tuple_to_receipt(inserted_receipt)
 
 
 @db_connection
-def list_receipt_records(conn, cur) -> list[Receipt]:
-    cur.execute("SELECT * FROM receipts")
-    rows = cur.fetchall()
+async def insert_receipt_records(
+    conn, cur, receipts: list[NewReceipt]
+) -> list[Receipt]:
+    """Insert many receipts with a single multi-row INSERT, in input order."""
+    if not receipts:
+        return []
+    values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(receipts))
+    params = [p for receipt in receipts for p in new_receipt_params(receipt)]
+    await cur.execute(
+        f"INSERT INTO receipts (name, key, data, datetime, status, image_hash, content_type) VALUES {values} RETURNING {RECEIPT_COLUMNS}",
+        params,
+    )
+    rows = await cur.fetchall()
+    await conn.commit()
+
+    # RETURNING order is not guaranteed, keys are unique so match on them
+    by_key = {r.key: r for r in map(tuple_to_receipt, rows)}
+    return [by_key[receipt.key] for receipt in receipts]
+
+
+def encode_cursor(receipt: Receipt) -> str:
+    """Opaque keyset cursor pointing just after receipt in list order."""
+    raw = f"{receipt.timestamp}|{receipt.id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Raises ValueError for malformed cursors."""
+    timestamp, _id = base64.urlsafe_b64decode(cursor).decode("utf-8").split("|")
+    return datetime.fromisoformat(timestamp), int(_id)
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@db_connection
+async def list_receipt_records(
+    conn,
+    cur,
+    limit: int | None = None,
+    cursor: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    store: str | None = None,
+    name: str | None = None,
+    fields: str = "full",
+) -> list[Receipt]:
+    """
+    Receipts newest first, optionally one keyset page at a time.
+
+    store matches the OCR'd store name case-insensitively, name is a
+    case-insensitive prefix. fields="summary" replaces data with just the
+    store name, date and total so the item list is never read.
+    """
+    conditions = []
+    params = []
+    if cursor is not None:
+        conditions.append("(datetime, id) < (%s, %s)")
+        params.extend(decode_cursor(cursor))
+    if since is not None:
+        conditions.append("datetime >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("datetime < %s")
+        params.append(until)
+    if store is not None:
+        conditions.append("lower(data->>'store_name') = lower(%s)")
+        params.append(store)
+    if name is not None:
+        conditions.append("lower(name) LIKE %s")
+        params.append(escape_like(name.lower()) + "%")
+
+    columns = RECEIPT_COLUMNS if fields == "full" else RECEIPT_SUMMARY_COLUMNS
+    query = f"SELECT {columns} FROM receipts"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY datetime DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+
+    await cur.execute(query, params)
+    rows = await cur.fetchall()
 
     return list(map(tuple_to_receipt, rows))
 
 
 @db_connection
-def get_receipt_record(conn, cur, receipt_id: str) -> Receipt:
-    cur.execute("SELECT * FROM receipts WHERE id = %s", (receipt_id,))
-    row = cur.fetchone()
+async def get_receipt_record(conn, cur, receipt_id: str) -> Receipt | None:
+    await cur.execute(
+        f"SELECT {RECEIPT_COLUMNS} FROM receipts WHERE id = %s", (receipt_id,)
+    )
+    row = await cur.fetchone()
+    if row is None:
+        return None
     return tuple_to_receipt(row)
 
 
+@db_connection
+async def find_receipts_by_image_hash(
+    conn, cur, image_hashes: list[str]
+) -> dict[str, Receipt]:
+    """Existing receipts for the given image hashes, keyed by hash."""
+    if not image_hashes:
+        return {}
+    await cur.execute(
+        f"SELECT DISTINCT ON (image_hash) {RECEIPT_COLUMNS} FROM receipts WHERE image_hash = ANY(%s) ORDER BY image_hash, id",
+        (image_hashes,),
+    )
+    rows = await cur.fetchall()
+    return {r.image_hash: r for r in map(tuple_to_receipt, rows)}
+
+
+@db_connection
+async def get_receipt_status(conn, cur, receipt_id: str) -> ReceiptStatus | None:
+    await cur.execute("SELECT id, status FROM receipts WHERE id = %s", (receipt_id,))
+    row = await cur.fetchone()
+    if row is None:
+        return None
+    return ReceiptStatus(id=row[0], status=row[1])
+
+
+@db_connection
+async def claim_receipt_record(conn, cur, receipt_id: int) -> bool:
+    """Move a pending receipt to processing, False if someone else got it first."""
+    await cur.execute(
+        "UPDATE receipts SET status = 'processing', claimed_at = now() WHERE id = %s AND status = 'pending' RETURNING id",
+        (receipt_id,),
+    )
+    claimed = await cur.fetchone()
+    await conn.commit()
+    return claimed is not None
+
+
+@db_connection
+async def update_receipt_data(conn, cur, receipt_id: int, data: dict, status: str):
+    # take back what an earlier OCR result of this receipt added
+    await apply_spending_aggregates(cur, receipt_id, -1)
+    await cur.execute(
+        "UPDATE receipts SET data = %s, status = %s WHERE id = %s",
+        (json.dumps(data), status, receipt_id),
+    )
+    await replace_receipt_items(cur, receipt_id, data)
+    await apply_spending_aggregates(cur, receipt_id, 1)
+    await conn.commit()
+
+
+@db_connection
+async def set_receipt_status(conn, cur, receipt_id: int, status: str):
+    await cur.execute(
+        "UPDATE receipts SET status = %s WHERE id = %s", (status, receipt_id)
+    )
+    await conn.commit()
+
+
+@db_connection
+async def reset_processing_receipt_records(conn, cur) -> int:
+    """
+    Put receipts left processing by a crash or shutdown back to pending, and
+    mark every pending receipt as on no queue so the first sweeps take them.
+
+    Only safe while no OCR worker runs: with several server processes this
+    happens once, before they start (serve.py).
+    """
+    await cur.execute(
+        "UPDATE receipts SET status = 'pending' WHERE status = 'processing'"
+    )
+    reset = cur.rowcount
+    await cur.execute("UPDATE receipts SET queued_at = NULL WHERE status = 'pending'")
+    await conn.commit()
+    return reset
+
+
+@db_connection
+async def reclaim_receipt_records(
+    conn, cur, stale_after: float, limit: int
+) -> tuple[int, list[tuple[int, str, str | None]]]:
+    """
+    Receipts for the caller's OCR queue that no live queue holds.
+
+    Receipts processing for longer than stale_after seconds (their worker
+    died) go back to pending first. Pending receipts whose queued_at is unset
+    or older than stale_after are then taken, up to limit, oldest first, and
+    get a new queued_at. SKIP LOCKED keeps sweeps of other processes from
+    taking the same ones. Returns the number reset and the (id, key,
+    image_hash) of the receipts taken.
+    """
+    await cur.execute(
+        """
+        UPDATE receipts SET status = 'pending', queued_at = NULL
+        WHERE status = 'processing' AND claimed_at < now() - make_interval(secs => %s)
+        """,
+        (stale_after,),
+    )
+    reset = cur.rowcount
+    await cur.execute(
+        """
+        UPDATE receipts SET queued_at = now()
+        WHERE id IN (
+            SELECT id FROM receipts
+            WHERE status = 'pending'
+                AND (queued_at IS NULL OR queued_at < now() - make_interval(secs => %s))
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, key, image_hash
+        """,
+        (stale_after, limit),
+    )
+    rows = sorted(await cur.fetchall())
+    await conn.commit()
+    return reset, rows
+
+
+@db_connection
+async def release_receipt_records(conn, cur, receipt_ids: list[int]):
+    """Mark pending receipts as on no queue, the next sweep of any process takes them."""
+    await cur.execute(
+        "UPDATE receipts SET queued_at = NULL WHERE id = ANY(%s) AND status = 'pending'",
+        (receipt_ids,),
+    )
+    await conn.commit()
+
+
 def delete_receipt_record():
     pass  # TODO: low priority
@@ -0,0 +1,566 @@
+"""
+Receipt extraction engine used by the API (ocrqueue) and the CLI.
+
+A backend turns a receipt image into raw receipt JSON: the Groq vision model,
+local Tesseract OCR, both tiered (local first, the vision model only for
+receipts local OCR cannot read confidently), or a canned stub. The engine in front of it validates
+and repairs the result, caches it by image hash and records metrics, so every
+path gets the same behaviour whichever backend is configured.
+
+    python -m extraction receipt.jpg [--backend stub]
+"""
+
+import config
+import argparse
+from abc import ABC, abstractmethod
+import base64
+import copy
+import hashlib
+import json
+import os
+import time
+import anyio
+from io import BytesIO
+from PIL import Image
+from pydantic import ValidationError
+from imagepreprocess import preprocess_for_ocr, encode_for_ocr, preprocess_signature
+from jsonextract import extract_json
+from llmclient import llm_client
+from metrics import get_logger, span
+from models import ReceiptData
+from ocrcache import OcrCache, make_ocr_cache
+from ocrmetrics import ocr_metrics
+from receipttext import parse_receipt_text, checksum_ok
+
+logger = get_logger("extraction")
+
+OCR_PROMPT = """
+                    Read the attached image and Return the information in json format.
+                    Return only a single json object.
+                    If you Cant find the information, return an empty object or leave fields empty.
+                    Do not add any additional text to the output.
+                    Only print JSON. Do not write reciept details.
+
+                    Example:
+
+                    Output format:
+                        JSON Object:
+                        {
+                            "date": "DD-MM-YYYY",
+                            "total_amount": 0.0,
+                            "items": [
+                                {
+                                    "name": "Item Name",
+                                    "quantity": 0,
+                                    "price": 0.0,
+                                    "category": "Item Category",
+                                    "sub_category": "Item Sub Category",
+                                    "is_heathly": true,
+                                    "is_organic": true,
+                                    "is_local": true,
+                                    "is_sustainable": true,
+
+
+                                }
+                            ],
+                            "tax": 0.0,
+                            "tip": 0.0,
+                            "store_name": "Store Name",
+                            "address": "Address",
+                            "phone_number": "Phone Number",
+                            "store_type": "Store Type"
+                        }
+
+                    Example Output: 
+
+                    ```{
+                        "date": "07-04-2017",
+                        "total_amount": 29.01,
+                        "items": [
+                            {
+                                "name": "Unknown Item",
+                                "quantity": 1,
+                                "price": 25.23
+                            }
+                        ],
+                        "tax": 3.78,
+                        "store_name": "Main Street Restaurant",
+                        "address": "6332 Business Drive Suite 528 Palo Alto California 94301",                        
+                        "phone_number": "575-1628095",
+                        "store_type": "Restaurant"
+                    }```
+                    
+                    """
+
+OCR_REPAIR_PROMPT = """
+    These fields were read from a shopping receipt but have invalid values.
+    Return a single JSON object with the same keys and corrected values:
+    dates as DD-MM-YYYY, amounts and quantities as plain numbers, yes/no fields
+    as true or false, and null when a value cannot be determined.
+
+    Fields:
+    """
+
+STUB_RECEIPT = {
+    "date": "07-04-2017",
+    "total_amount": 29.01,
+    "items": [{"name": "Unknown Item", "quantity": 1, "price": 25.23}],
+    "tax": 3.78,
+    "store_name": "Main Street Restaurant",
+    "address": "6332 Business Drive Suite 528 Palo Alto California 94301",
+    "phone_number": "575-1628095",
+    "store_type": "Restaurant",
+}
+
+
+def encode_image(pil_img, format="JPEG"):
+    with span("decode"):
+        img = preprocess_for_ocr(pil_img)
+    with span("encode"):
+        img_bytes = encode_for_ocr(img, format=format)
+    encoded = base64.b64encode(img_bytes).decode("utf-8")
+    return encoded
+
+
+def calculate_sha256(pil_img, format="PNG"):
+    """sha256 of the image's pixels re-encoded losslessly, for when only a decoded image is at hand."""
+    buffer = BytesIO()
+    pil_img.save(buffer, format=format)
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+def hash_image_file(image_path, chunk_size=1024 * 1024):
+    """sha256 of the raw file bytes, the same digest store_receipt_image returns."""
+    sha256 = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ExtractionBackend(ABC):
+    """Turns a receipt image into raw receipt JSON (validated by the engine)."""
+
+    name = ""
+    # whether fields failing validation are worth a text-only LLM repair call
+    repairable = False
+
+    @abstractmethod
+    def extract(self, pil_img) -> dict:
+        """Raw receipt JSON, raises when the image could not be read (model unreachable, ...)."""
+
+    def signature(self) -> str:
+        """Everything that changes this backend's output, part of the cache key."""
+        return self.name
+
+
+class GroqVisionBackend(ExtractionBackend):
+    name = "groq"
+    repairable = True
+
+    def __init__(self, model=config.OCR_MODEL, json_mode=config.OCR_JSON_MODE):
+        self.model = model
+        self.json_mode = json_mode
+
+    def signature(self):
+        return f"{self.name}:{self.model}:{hash_text(OCR_PROMPT)}:json={self.json_mode}:{preprocess_signature()}"
+
+    def ocr_reciept(self, pil_img) -> str:
+        start = time.perf_counter()
+        try:
+            return self.request_ocr(pil_img)
+        finally:
+            ocr_metrics.observe("vision", time.perf_counter() - start)
+
+    def request_ocr(self, pil_img) -> str:
+        base64_image = encode_image(pil_img)
+        options = {"response_format": {"type": "json_object"}} if self.json_mode else {}
+        with span("llm_call", model=self.model):
+            chat_completion = llm_client.get().chat(
+                messages=[
+                    # Cant use system message along with images in other messages for some reason.
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": OCR_PROMPT,
+                            },
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/jpeg;base64,{base64_image}",
+                                },
+                            },
+                        ],
+                    }
+                ],
+                model=self.model,
+                temperature=0.1,
+                **options,
+            )
+        return chat_completion.choices[0].message.content
+
+    def extract(self, pil_img):
+        llm_resp = self.ocr_reciept(pil_img)
+        if config.OCR_SAVE_REPLIES_DIR:
+            os.makedirs(config.OCR_SAVE_REPLIES_DIR, exist_ok=True)
+            path = os.path.join(config.OCR_SAVE_REPLIES_DIR, f"llm_resp_{hash_text(llm_resp)}.txt")
+            with open(path, "w") as f:
+                f.write(llm_resp)
+        with span("json_parse"):
+            return extract_json(llm_resp)
+
+
+class TesseractBackend(ExtractionBackend):
+    """Local OCR, no network or API quota. Needs pytesseract and the tesseract binary."""
+
+    name = "tesseract"
+
+    def __init__(self, lang=config.OCR_TESSERACT_LANG):
+        try:
+            import pytesseract
+        except ImportError as e:
+            raise RuntimeError(
+                "OCR_BACKEND=tesseract needs pytesseract (pip install pytesseract) and tesseract installed"
+            ) from e
+        try:
+            # also finds a missing binary here rather than on the first receipt
+            self.version = pytesseract.get_tesseract_version()
+        except OSError as e:
+            raise RuntimeError(f"OCR_BACKEND=tesseract needs the tesseract binary: {e}") from e
+        self.pytesseract = pytesseract
+        self.lang = lang
+
+    def signature(self):
+        return f"{self.name}:{self.version}:{self.lang}:{preprocess_signature()}"
+
+    def read(self, pil_img) -> tuple[str, float]:
+        """The text, one OCR line per line, and the mean word confidence (0-100)."""
+        with span("decode"):
+            img = preprocess_for_ocr(pil_img)
+        with span("local_ocr"):
+            data = self.pytesseract.image_to_data(
+                img, lang=self.lang, output_type=self.pytesseract.Output.DICT
+            )
+        lines = {}
+        confidences = []
+        for i, word in enumerate(data["text"]):
+            if not word.strip():
+                continue
+            line = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            lines.setdefault(line, []).append(word)
+            # -1 for boxes without text
+            if float(data["conf"][i]) >= 0:
+                confidences.append(float(data["conf"][i]))
+        text = "\n".join(" ".join(words) for words in lines.values())
+        return text, sum(confidences) / len(confidences) if confidences else 0.0
+
+    def extract(self, pil_img):
+        text, _ = self.read(pil_img)
+        return parse_receipt_text(text)
+
+
+class TieredBackend(ExtractionBackend):
+    """
+    Tesseract first, the vision LLM only when the local read is not trusted:
+    low word confidence, no items or total, or items not adding up to the total.
+    Without pytesseract every receipt goes to the LLM.
+    """
+
+    name = "tiered"
+    repairable = True
+
+    def __init__(
+        self,
+        local=None,
+        fallback=None,
+        min_confidence=config.OCR_LOCAL_MIN_CONFIDENCE,
+        tolerance=config.OCR_CHECKSUM_TOLERANCE,
+    ):
+        if local is None:
+            try:
+                local = TesseractBackend()
+            except RuntimeError as e:
+                logger.warning(f"local OCR unavailable, using the vision LLM only: {e}")
+        self.local = local
+        self.fallback = fallback or GroqVisionBackend()
+        self.min_confidence = min_confidence
+        self.tolerance = tolerance
+
+    def signature(self):
+        local = self.local.signature() if self.local else "none"
+        return (
+            f"{self.name}:{local}:{self.fallback.signature()}"
+            f":conf={self.min_confidence}:tolerance={self.tolerance}"
+        )
+
+    def read_locally(self, pil_img) -> tuple[dict | None, str]:
+        """The local result when it can be trusted, and the routing counter to bump."""
+        start = time.perf_counter()
+        try:
+            text, confidence = self.local.read(pil_img)
+        except Exception as e:
+            logger.warning(f"local OCR failed, falling back to the vision LLM: {e!r}")
+            return None, "local_errors"
+        finally:
+            ocr_metrics.observe("local", time.perf_counter() - start)
+        if confidence < self.min_confidence:
+            return None, "local_low_confidence"
+        receipt = parse_receipt_text(text)
+        if not receipt["items"] or receipt.get("total_amount") is None:
+            return None, "local_incomplete"
+        if not checksum_ok(receipt, self.tolerance):
+            return None, "local_checksum_failed"
+        return receipt, "local_accepted"
+
+    def extract(self, pil_img):
+        if self.local is None:
+            return self.fallback.extract(pil_img)
+        receipt, route = self.read_locally(pil_img)
+        ocr_metrics.count(route)
+        if receipt is not None:
+            return receipt
+        return self.fallback.extract(pil_img)
+
+
+class StubBackend(ExtractionBackend):
+    """Returns the same receipt for every image, for development and load tests."""
+
+    name = "stub"
+
+    def __init__(self, response_path=config.OCR_STUB_RESPONSE):
+        self.response = STUB_RECEIPT
+        if response_path:
+            with open(response_path) as f:
+                self.response = json.load(f)
+
+    def signature(self):
+        return f"{self.name}:{hash_text(json.dumps(self.response, sort_keys=True))}"
+
+    def extract(self, pil_img):
+        return copy.deepcopy(self.response)
+
+
+BACKENDS = {
+    "groq": GroqVisionBackend,
+    "tesseract": TesseractBackend,
+    "tiered": TieredBackend,
+    "stub": StubBackend,
+}
+
+
+def make_backend(name: str = config.OCR_BACKEND) -> ExtractionBackend:
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown OCR_BACKEND: {name}")
+    return BACKENDS[name]()
+
+
+def get_path(data, path: tuple):
+    for key in path:
+        data = data[key]
+    return data
+
+
+def set_path(data, path: tuple, value):
+    for key in path[:-1]:
+        data = data[key]
+    data[path[-1]] = value
+
+
+def normalize_items(raw: dict) -> dict:
+    """items as a list of objects, so validation error paths index the same list."""
+    items = raw.get("items")
+    if isinstance(items, dict):
+        return {**raw, "items": [items]}
+    if isinstance(items, list):
+        return {**raw, "items": [item for item in items if isinstance(item, dict)]}
+    return raw
+
+
+def validate_receipt(raw: dict) -> tuple[dict, dict[tuple, object]]:
+    """
+    Coerce an OCR result to ReceiptData.
+
+    Fields that cannot be coerced are set to null. Returns the validated data
+    and the original values of those fields keyed by their path.
+    """
+    data = copy.deepcopy(raw)
+    failures = {}
+    # each round nulls every failing field, a second round only sees new structure errors
+    for _ in range(3):
+        try:
+            return ReceiptData.model_validate(data).model_dump(), failures
+        except ValidationError as e:
+            for error in e.errors():
+                path = error["loc"]
+                try:
+                    failures[path] = get_path(raw, path)
+                    set_path(data, path, None)
+                except (KeyError, IndexError, TypeError):
+                    pass
+    return {}, failures
+
+
+def repair_fields(failures: dict[tuple, object]) -> dict[tuple, object]:
+    """Corrected values for the failing fields from one text-only LLM call."""
+    fields = {".".join(str(key) for key in path): value for path, value in failures.items()}
+    start = time.perf_counter()
+    ocr_metrics.count("repair_calls")
+    try:
+        completion = llm_client.get().chat(
+            messages=[
+                {
+                    "role": "user",
+                    "content": OCR_REPAIR_PROMPT + json.dumps(fields, default=str),
+                }
+            ],
+            model=config.OCR_REPAIR_MODEL,
+            temperature=0,
+            response_format={"type": "json_object"},
+        )
+        repaired = extract_json(completion.choices[0].message.content)
+    except Exception as e:
+        logger.warning(f"OCR field repair failed: {e!r}")
+        ocr_metrics.count("repair_failures")
+        return {}
+    finally:
+        ocr_metrics.observe("repair", time.perf_counter() - start)
+    if not isinstance(repaired, dict):
+        return {}
+    return {path: repaired[name] for name, path in zip(fields, failures) if name in repaired}
+
+
+class ExtractionEngine:
+    def __init__(
+        self,
+        backend: ExtractionBackend,
+        cache: OcrCache,
+        repair: bool = config.OCR_REPAIR,
+        concurrency: int = config.OCR_CONCURRENCY,
+    ):
+        self.backend = backend
+        self.cache = cache
+        self.repair = repair and backend.repairable
+        self.limiter = anyio.CapacityLimiter(concurrency)
+        # computed once, every cache lookup needs it
+        self.version = hash_text(
+            f"{backend.signature()}\nrepair={self.repair}:{config.OCR_REPAIR_MODEL}"
+        )
+
+    def cache_key(self, image_hash: str) -> str:
+        """
+        Cache key for the extraction result of an image.
+
+        Versioned by the backend (model, prompt, preprocessing) and repair
+        settings so changing any of them invalidates earlier results.
+        """
+        return hash_text(f"{self.version}:{image_hash}")
+
+    def extract(self, pil_img) -> dict:
+        """
+        The validated result for an image, {} when the backend returned nothing usable.
+
+        Backend errors (model unreachable, rate limited) are raised, so the
+        caller can tell them from an empty read and retry.
+        """
+        start = time.perf_counter()
+        ocr_metrics.count("ocr_calls")
+        try:
+            with span("extract", backend=self.backend.name):
+                raw = self.backend.extract(pil_img)
+        except Exception:
+            ocr_metrics.count("ocr_failures")
+            raise
+        finally:
+            ocr_metrics.observe("ocr", time.perf_counter() - start)
+        if not isinstance(raw, dict) or not raw:
+            ocr_metrics.count("ocr_failures")
+            return {}
+
+        raw = normalize_items(raw)
+        with span("validate"):
+            data, failures = validate_receipt(raw)
+        if not failures:
+            return data
+
+        ocr_metrics.count("invalid_results")
+        if not self.repair:
+            ocr_metrics.count("fields_dropped", len(failures))
+            return data
+        with span("repair", fields=len(failures)):
+            repaired = repair_fields(failures)
+        raw = copy.deepcopy(raw)
+        for path, value in repaired.items():
+            set_path(raw, path, value)
+        data, still_failing = validate_receipt(raw)
+        ocr_metrics.count("fields_repaired", len(failures) - len(still_failing))
+        ocr_metrics.count("fields_dropped", len(still_failing))
+        return data
+
+    def process_receipt(self, pil_img, cache_key=None):
+        if cache_key is None:
+            # only a decoded image is available, hash its re-encoded pixels
+            cache_key = self.cache_key(calculate_sha256(pil_img))
+        return self.cache.get_or_compute(cache_key, lambda: self.extract(pil_img))
+
+    def get_receipt_json(self, image_path, image_hash=None):
+        """
+        Extract the receipt at image_path.
+
+        image_hash is the sha256 of the raw file bytes (computed while the upload
+        was streamed to disk). The cache is checked with it before the image is
+        ever decoded.
+        """
+        if image_hash is None:
+            image_hash = hash_image_file(image_path)
+
+        def decode_and_extract():
+            with Image.open(image_path) as img:
+                return self.extract(img)
+
+        return self.cache.get_or_compute(self.cache_key(image_hash), decode_and_extract)
+
+    async def get_receipt_json_async(self, image_path, image_hash=None):
+        """Run get_receipt_json on a worker thread so the event loop keeps serving."""
+        return await anyio.to_thread.run_sync(
+            self.get_receipt_json, image_path, image_hash, limiter=self.limiter
+        )
+
+    def stats(self) -> dict:
+        return {"backend": self.backend.name, **self.cache.stats()}
+
+
+engine: ExtractionEngine | None = None
+
+
+def get_engine() -> ExtractionEngine:
+    """The shared engine for the configured backend, created on first use."""
+    global engine
+    if engine is None:
+        engine = ExtractionEngine(make_backend(), make_ocr_cache())
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract receipt JSON from images")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=config.OCR_BACKEND)
+    args = parser.parse_args()
+
+    global engine
+    engine = ExtractionEngine(make_backend(args.backend), make_ocr_cache())
+    for path in args.images:
+        try:
+            result = engine.get_receipt_json(path)
+        except Exception as e:
+            result = {"error": str(e)}
+        print(json.dumps({path: result}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,219 @@
-import googlemaps
+"""
+Nearby place search (Google Places Nearby Search) for GET /places/nearby.
+
+Searches are bucketed by geohash cell: every location in a cell is searched
+from the cell centre, so users in the same area share one cached result and
+concurrent misses for it share one upstream request. Results are cached per
+page with a TTL and LRU eviction. Google only serves page n + 1 a moment after
+returning its token, so the next page is fetched in the background as soon as
+the token arrives instead of sleeping in the request.
+Set PLACES_BASE_URL to point at a local fake server (benchmarks/fake_places.py).
+
+    python -m findnearbyplaces 37.7749 -122.4194 --keyword "Farmer Market"
+"""
+
+import config
+import argparse
+import asyncio
 import json
+import math
+import os
 import time
+import httpx
+from upstream import CoalescingCache, Shared
+
+GOOGLE_MAPS_API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY", "")
+PLACES_BASE_URL = os.environ.get("PLACES_BASE_URL", "https://maps.googleapis.com")
+PLACES_TIMEOUT = float(os.environ.get("PLACES_TIMEOUT", "10"))
+PLACES_MAX_CONNECTIONS = int(os.environ.get("PLACES_MAX_CONNECTIONS", "10"))
+# 6 characters is a cell of about 1.2 x 0.6 km
+PLACES_GEOHASH_PRECISION = int(os.environ.get("PLACES_GEOHASH_PRECISION", "6"))
+PLACES_CACHE_ENTRIES = int(os.environ.get("PLACES_CACHE_ENTRIES", "2048"))
+# seconds a page of results stays valid, 1 hour by default
+PLACES_CACHE_TTL = float(os.environ.get("PLACES_CACHE_TTL", "3600"))
+# a next_page_token is rejected (INVALID_REQUEST) for about two seconds after it is issued
+PLACES_PAGE_TOKEN_DELAY = float(os.environ.get("PLACES_PAGE_TOKEN_DELAY", "1.5"))
+PLACES_PAGE_TOKEN_RETRY_DELAY = float(os.environ.get("PLACES_PAGE_TOKEN_RETRY_DELAY", "0.5"))
+PLACES_PAGE_TOKEN_ATTEMPTS = int(os.environ.get("PLACES_PAGE_TOKEN_ATTEMPTS", "5"))
+
+NEARBY_SEARCH_PATH = "/maps/api/place/nearbysearch/json"
+# the API's largest radius in meters
+MAX_RADIUS = 50000
+# the API returns at most 60 results, 3 pages of 20
+MAX_PAGES = 3
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+METERS_PER_DEGREE = 111320
+
+
+class PlacesError(Exception):
+    pass
+
+
+def geohash_cell(lat: float, lng: float, precision: int) -> tuple[str, tuple[float, float], float]:
+    """The geohash of a point, its cell's centre and the cell's half diagonal in meters."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    cell = ""
+    bits = 0
+    value = 0
+    even = True
+    while len(cell) < precision:
+        # bits alternate between longitude and latitude, longitude first
+        bounds, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            cell += GEOHASH_BASE32[value]
+            bits = 0
+            value = 0
+
+    center = ((lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2)
+    height = (lat_range[1] - lat_range[0]) * METERS_PER_DEGREE
+    width = (lng_range[1] - lng_range[0]) * METERS_PER_DEGREE * math.cos(math.radians(center[0]))
+    return cell, center, math.hypot(height, width) / 2
+
+
+class PlaceSearch:
+    def __init__(self, api_key: str = GOOGLE_MAPS_API_KEY, base_url: str = PLACES_BASE_URL):
+        self.api_key = api_key
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=PLACES_TIMEOUT,
+            limits=httpx.Limits(max_connections=PLACES_MAX_CONNECTIONS),
+        )
+        # a failed prefetch nobody waited for is only logged, the page is fetched again on request
+        self.cache = CoalescingCache("places", PLACES_CACHE_ENTRIES, PLACES_CACHE_TTL, log_errors=True)
+        self.counters = {
+            "prefetches": 0,
+            "upstream_requests": 0,
+            "page_token_retries": 0,
+        }
+
+    def area(self, location, radius: int, place_type=None, keyword=None) -> tuple[str, dict]:
+        """Cache key and request parameters for a search around location."""
+        cell, center, half_diagonal = geohash_cell(*location, PLACES_GEOHASH_PRECISION)
+        params = {
+            "location": f"{center[0]:.6f},{center[1]:.6f}",
+            # widened so the circle around any point of the cell is covered
+            "radius": min(MAX_RADIUS, round(radius + half_diagonal)),
+        }
+        if place_type:
+            params["type"] = place_type
+        if keyword:
+            params["keyword"] = keyword
+        key = json.dumps([cell, radius, place_type or "", keyword or ""])
+        return key, params
+
+    async def request(self, params: dict) -> dict:
+        self.counters["upstream_requests"] += 1
+        response = await self.client.get(NEARBY_SEARCH_PATH, params={**params, "key": self.api_key})
+        response.raise_for_status()
+        return response.json()
+
+    async def request_next_page(self, token: str) -> dict:
+        await asyncio.sleep(PLACES_PAGE_TOKEN_DELAY)
+        for attempt in range(PLACES_PAGE_TOKEN_ATTEMPTS):
+            body = await self.request({"pagetoken": token})
+            if body.get("status") != "INVALID_REQUEST":
+                break
+            self.counters["page_token_retries"] += 1
+            await asyncio.sleep(PLACES_PAGE_TOKEN_RETRY_DELAY)
+        return body
 
-def search_nearby_similar_places(api_key, location, radius, place_type=None, keyword=None):
+    async def fetch_page(self, key: str, params: dict, page: int, token: str | None) -> dict:
+        if page == 0:
+            body = await self.request(params)
+        else:
+            body = await self.request_next_page(token)
 
-    client = googlemaps.Client(key=api_key)
+        status = body.get("status")
+        if status not in ("OK", "ZERO_RESULTS"):
+            raise PlacesError(f"Places search failed: {status} {body.get('error_message', '')}".strip())
+        result = {"results": body.get("results", []), "next_page_token": body.get("next_page_token")}
+        if result["next_page_token"] and page + 1 < MAX_PAGES:
+            self.counters["prefetches"] += 1
+            token = result["next_page_token"]
+            self.cache.start(f"{key}:{page + 1}", lambda: self.fetch_page(key, params, page + 1, token))
+        return result
+
+    async def page(self, key: str, params: dict, page: int) -> dict:
+        """
+        Page n, walked to from the first page, since a page's token only comes
+        with the page before it. Stops at the last page the API has.
+        """
+        if page >= MAX_PAGES:
+            return {"results": [], "next_page_token": None}
+        token = None
+        for n in range(page + 1):
+            result = await self.cache.get(
+                f"{key}:{n}",
+                lambda n=n, token=token: self.fetch_page(key, params, n, token),
+                count=n == page,
+            )
+            token = result["next_page_token"]
+            if token is None and n < page:
+                return {"results": [], "next_page_token": None}
+        return result
+
+    async def search(
+        self, location, radius: int, place_type=None, keyword=None, page: int = 0
+    ) -> tuple[list[dict], int | None]:
+        """One page of places near location, and the number of the next page if there is one."""
+        key, params = self.area(location, radius, place_type, keyword)
+        result = await self.page(key, params, page)
+        more = result["next_page_token"] and page + 1 < MAX_PAGES
+        return result["results"], page + 1 if more else None
+
+    async def close(self):
+        await self.cache.close()
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), **self.counters}
+
+
+place_search = Shared(PlaceSearch)
+
+
+async def search_nearby_similar_places(location, radius, place_type=None, keyword=None):
+    """Every page of results, pages after the first come from the prefetch."""
+    search = place_search.get()
     all_results = []
-    
-    # Perform the initial nearby search
-    response = client.places_nearby(location=location, radius=radius, type=place_type, keyword=keyword)
-    all_results.extend(response.get("results", []))
-    
-    # Google Maps may return a next_page_token if there are additional pages.
-    while "next_page_token" in response:
-        # Pause to allow the next page token to become active
-        time.sleep(2)
-        response = client.places_nearby(page_token=response["next_page_token"])
-        all_results.extend(response.get("results", []))
-    
+    page = 0
+    while page is not None:
+        results, page = await search.search(location, radius, place_type, keyword, page)
+        all_results.extend(results)
     return all_results
 
-if __name__ == "__main__":
-    # Replace with your actual Google Maps API key.
-    API_KEY = "YOUR_API_KEY_HERE"
-    
-    # Define the center location as a (latitude, longitude) tuple.
-    # For example, this sample location is in San Francisco.
-    location = (37.7749, -122.4194)
-    
-    # Define the search radius (in meters).
-    radius = 1000  # 1 kilometer
-    
-    # Optionally, set the type of place to search for and a keyword.
-    place_type = "Farmer Market"  # For example, restaurants
-    keyword = "Farmer Market"  # To find similar places, e.g., Italian restaurants
-    
-    results = search_nearby_similar_places(API_KEY, location, radius, place_type, keyword)
-    
-    # Print the results in a readable JSON format
+
+async def run_cli(args):
+    start = time.perf_counter()
+    try:
+        results = await search_nearby_similar_places(
+            (args.lat, args.lng), args.radius, args.type, args.keyword
+        )
+    finally:
+        await place_search.close()
     print(json.dumps(results, indent=2))
+    print(f"{len(results)} places in {time.perf_counter() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search places near a location")
+    parser.add_argument("lat", type=float)
+    parser.add_argument("lng", type=float)
+    parser.add_argument("--radius", type=int, default=1000, help="meters")
+    parser.add_argument("--type", default=None, help="a Places type, e.g. grocery_or_supermarket")
+    parser.add_argument("--keyword", default=None)
+    asyncio.run(run_cli(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+from io import BytesIO
+from PIL import Image, ImageFilter, ImageOps
+
+OCR_MAX_LONG_EDGE = int(os.environ.get("OCR_MAX_LONG_EDGE", "1600"))
+OCR_GRAYSCALE = os.environ.get("OCR_GRAYSCALE", "1") == "1"
+OCR_CROP = os.environ.get("OCR_CROP", "1") == "1"
+OCR_JPEG_QUALITY = int(os.environ.get("OCR_JPEG_QUALITY", "85"))
+OCR_MIN_JPEG_QUALITY = int(os.environ.get("OCR_MIN_JPEG_QUALITY", "50"))
+# encoded payload size to aim for, quality is lowered until it fits
+OCR_TARGET_BYTES = int(os.environ.get("OCR_TARGET_BYTES", "300000"))
+
+# long edge of the copy used to locate the receipt paper
+CROP_ANALYSIS_SIZE = 400
+CROP_MARGIN = 0.02
+
+
+def preprocess_signature() -> str:
+    """Settings that change what the model sees, part of the OCR cache key."""
+    return (
+        f"edge={OCR_MAX_LONG_EDGE};gray={OCR_GRAYSCALE};crop={OCR_CROP};"
+        f"q={OCR_JPEG_QUALITY}-{OCR_MIN_JPEG_QUALITY};target={OCR_TARGET_BYTES}"
+    )
+
+
+def otsu_threshold(histogram: list[int]) -> int:
+    total = sum(histogram)
+    sum_all = sum(i * h for i, h in enumerate(histogram))
+    sum_bg = 0
+    weight_bg = 0
+    best_threshold = 0
+    best_variance = 0.0
+    for i, h in enumerate(histogram):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += i * h
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if variance > best_variance:
+            best_variance = variance
+            best_threshold = i
+    return best_threshold
+
+
+def crop_to_receipt(img):
+    """
+    Crop to the bright paper region of the photo.
+
+    Left unchanged when no clear receipt is found (the paper is almost all of
+    the frame or only a small speck of it).
+    """
+    # integer box reduction is much cheaper than a resampling resize here
+    small = ImageOps.grayscale(img).reduce(max(1, max(img.size) // CROP_ANALYSIS_SIZE))
+    small = small.filter(ImageFilter.BoxBlur(2))
+    threshold = otsu_threshold(small.histogram())
+    mask = small.point(lambda p: 255 if p > threshold else 0)
+    # drop bright specks in the background before taking the bounding box
+    mask = mask.filter(ImageFilter.MinFilter(3))
+    bbox = mask.getbbox()
+    if bbox is None:
+        return img
+
+    left, top, right, bottom = bbox
+    area = (right - left) * (bottom - top) / (small.width * small.height)
+    if area < 0.1 or area > 0.9:
+        return img
+
+    scale_x = img.width / small.width
+    scale_y = img.height / small.height
+    margin_x = img.width * CROP_MARGIN
+    margin_y = img.height * CROP_MARGIN
+    return img.crop(
+        (
+            max(0, int(left * scale_x - margin_x)),
+            max(0, int(top * scale_y - margin_y)),
+            min(img.width, int(right * scale_x + margin_x)),
+            min(img.height, int(bottom * scale_y + margin_y)),
+        )
+    )
+
+
+def preprocess_for_ocr(pil_img):
+    """Rotate per EXIF, optionally grayscale and crop, then downscale."""
+    if pil_img.format == "JPEG" and max(pil_img.size) > OCR_MAX_LONG_EDGE:
+        # let the JPEG decoder skip detail we would throw away, only works before load()
+        scale = OCR_MAX_LONG_EDGE / max(pil_img.size)
+        pil_img.draft(
+            "L" if OCR_GRAYSCALE else "RGB",
+            (int(pil_img.width * scale), int(pil_img.height * scale)),
+        )
+    img = ImageOps.exif_transpose(pil_img)
+    img = img.convert("L") if OCR_GRAYSCALE else img.convert("RGB")
+    if OCR_CROP:
+        img = crop_to_receipt(img)
+    if max(img.size) > OCR_MAX_LONG_EDGE:
+        img.thumbnail(
+            (OCR_MAX_LONG_EDGE, OCR_MAX_LONG_EDGE),
+            Image.Resampling.BICUBIC,
+            reducing_gap=2.0,
+        )
+    return img
+
+
+def encode_for_ocr(img, format="JPEG") -> bytes:
+    """Encode at the highest quality that fits OCR_TARGET_BYTES (or the minimum quality)."""
+    quality = OCR_JPEG_QUALITY
+    while True:
+        buffered = BytesIO()
+        img.save(buffered, format=format, quality=quality, optimize=True)
+        if buffered.tell() <= OCR_TARGET_BYTES or quality <= OCR_MIN_JPEG_QUALITY:
+            return buffered.getvalue()
+        quality = max(OCR_MIN_JPEG_QUALITY, quality - 10)
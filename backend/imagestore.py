@@ -1,18 +1,177 @@
 from fastapi import UploadFile
-from pathlib import Path
+from models import StoredImage
+from PIL import Image, ImageOps
+import anyio
+import asyncio
+import hashlib
+import os
+import time
+from metrics import observe_stage
 
 IMAGES_FOLDER = "images"
+CHUNK_SIZE = 1024 * 1024
+# uploads bigger than this are rejected, 20 MiB by default
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
 
 
-def get_image_location(key: str) -> str:
-    return f"{IMAGES_FOLDER}/{key}"
+class ImageRejected(Exception):
+    pass
 
 
-async def store_receipt_image(key: str, image: UploadFile):
-    image_bytes = await image.read()
-    with open(get_image_location(key), "+wb") as f:
-        f.write(image_bytes)
+class ImageTooLarge(ImageRejected):
+    pass
 
 
-def delete_receipt_image(key: str):
-    Path.unlink(get_image_location(key))
+class UnsupportedImageType(ImageRejected):
+    pass
+
+
+def sniff_content_type(head: bytes) -> str | None:
+    """MIME type from the file's magic bytes, None for anything we can't decode."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith((b"II*\x00", b"MM\x00*")):
+        return "image/tiff"
+    if head.startswith(b"BM"):
+        return "image/bmp"
+    return None
+
+
+def get_shard_location(key: str) -> str:
+    # keys are random hex, so their first characters spread files evenly
+    return f"{IMAGES_FOLDER}/{key[:2]}/{key[2:4]}/{key}"
+
+
+async def get_image_location(key: str) -> str:
+    location = get_shard_location(key)
+    # images stored before sharding sit directly in IMAGES_FOLDER
+    legacy_location = f"{IMAGES_FOLDER}/{key}"
+    if not await anyio.Path(location).exists() and await anyio.Path(legacy_location).exists():
+        return legacy_location
+    return location
+
+
+def sniff_file_content_type(path: str) -> str | None:
+    with open(path, "rb") as f:
+        return sniff_content_type(f.read(16))
+
+
+async def store_receipt_image(key: str, image: UploadFile) -> StoredImage:
+    """
+    Stream the upload to a temp file and atomically move it into place.
+
+    The bytes are hashed and the type sniffed on the way through, so memory
+    use stays at one chunk regardless of the image size. Raises ImageRejected
+    (and leaves nothing behind) for unknown types or uploads over MAX_IMAGE_BYTES.
+    """
+    if image.size is not None and image.size > MAX_IMAGE_BYTES:
+        raise ImageTooLarge(f"Image is larger than {MAX_IMAGE_BYTES} bytes")
+
+    location = anyio.Path(get_shard_location(key))
+    await location.parent.mkdir(parents=True, exist_ok=True)
+    temp_location = anyio.Path(f"{location}.part")
+    sha256 = hashlib.sha256()
+    hash_seconds = 0.0
+    size = 0
+    content_type = None
+    try:
+        async with await anyio.open_file(temp_location, "wb") as f:
+            while chunk := await image.read(CHUNK_SIZE):
+                if content_type is None:
+                    content_type = sniff_content_type(chunk)
+                    if content_type is None:
+                        raise UnsupportedImageType("Upload is not a supported image")
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise ImageTooLarge(f"Image is larger than {MAX_IMAGE_BYTES} bytes")
+                start = time.perf_counter()
+                sha256.update(chunk)
+                hash_seconds += time.perf_counter() - start
+                await f.write(chunk)
+        if content_type is None:
+            raise UnsupportedImageType("Upload is empty")
+        await temp_location.replace(location)
+    except BaseException:
+        await temp_location.unlink(missing_ok=True)
+        raise
+
+    observe_stage("hash", hash_seconds, bytes=size)
+    return StoredImage(sha256=sha256.hexdigest(), content_type=content_type, size=size)
+
+
+async def delete_receipt_image(key: str):
+    location = anyio.Path(await get_image_location(key))
+    await location.unlink()
+    async for rendition in location.parent.glob(f"{key}.*"):
+        await rendition.unlink(missing_ok=True)
+
+
+# long edge in pixels of each generated rendition
+RENDITION_SIZES = {"thumb": 320, "medium": 1280}
+RENDITION_QUALITY = int(os.environ.get("RENDITION_QUALITY", "80"))
+RENDITION_CONTENT_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+}
+
+Image.init()
+# AVIF needs a Pillow build with the codec, WebP is in every wheel
+RENDITION_FORMATS = [f for f in ("avif", "webp") if f.upper() in Image.SAVE] + ["jpeg"]
+
+rendition_locks: dict[str, asyncio.Lock] = {}
+
+
+def negotiate_rendition_format(accept: str | None) -> str:
+    """Best format the client accepts, JPEG when it does not say."""
+    accept = accept or ""
+    for format in RENDITION_FORMATS[:-1]:
+        if RENDITION_CONTENT_TYPES[format] in accept:
+            return format
+    return "jpeg"
+
+
+async def get_rendition_location(key: str, size: str, format: str) -> str:
+    # next to the original, so one glob finds everything to delete
+    original = anyio.Path(await get_image_location(key))
+    return str(original.parent / f"{key}.{size}.{format}")
+
+
+def render_rendition(source: str, target: str, size: str, format: str):
+    long_edge = RENDITION_SIZES[size]
+    with Image.open(source) as img:
+        img.draft("RGB", (long_edge, long_edge))
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((long_edge, long_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        temp_target = f"{target}.part"
+        img.save(temp_target, format=format.upper(), quality=RENDITION_QUALITY)
+        os.replace(temp_target, target)
+
+
+async def get_rendition(key: str, size: str, format: str) -> str:
+    """
+    Path of the requested rendition, rendered on first request.
+
+    Concurrent requests for the same missing rendition render it once.
+    """
+    target = await get_rendition_location(key, size, format)
+    if await anyio.Path(target).exists():
+        return target
+
+    lock = rendition_locks.setdefault(target, asyncio.Lock())
+    try:
+        async with lock:
+            if not await anyio.Path(target).exists():
+                await anyio.to_thread.run_sync(
+                    render_rendition, await get_image_location(key), target, size, format
+                )
+    finally:
+        # also when rendering failed, or every broken source would keep a lock
+        rendition_locks.pop(target, None)
+    return target
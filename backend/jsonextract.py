@@ -0,0 +1,283 @@
+"""
+Pull the JSON object out of an LLM reply.
+
+Models wrap their JSON in prose or ``` fences, write Python-style literals,
+single quotes, unquoted keys and trailing commas, and get cut off at the token
+limit. extract_json first tries the strict decoder at the first '{' (the common
+case, in C). If that fails, it re-reads the object once with a tolerant
+scanner that understands strings and escapes, normalises it to valid JSON and
+closes whatever was left open.
+"""
+
+import json
+import re
+
+# objects tried before giving up, each attempt is one linear pass
+MAX_ATTEMPTS = 3
+
+decoder = json.JSONDecoder()
+
+LITERALS = {
+    "true": "true",
+    "false": "false",
+    "null": "null",
+    "True": "true",
+    "False": "false",
+    "None": "null",
+    "NaN": "null",
+    "Infinity": "null",
+    "-Infinity": "null",
+}
+VALID_ESCAPES = set('"\\/bfnrtu')
+# characters that end a run of plain string content, per opening quote
+STRING_SPECIAL = {
+    '"': re.compile(r'["\\\x00-\x1f]'),
+    "'": re.compile(r"['\"\\\x00-\x1f]"),
+}
+DELIMITERS = set(" \t\r\n,:{}[]\"'`/")
+CLOSERS = {"{": "}", "[": "]"}
+
+
+class JsonExtractError(ValueError):
+    pass
+
+
+def extract_json(text: str, repair: bool = True):
+    """The first JSON object in text, repaired if needed. Raises JsonExtractError."""
+    for start in candidate_starts(text):
+        try:
+            value, _ = decoder.raw_decode(text, start)
+            return value
+        except ValueError:
+            pass
+        if not repair:
+            continue
+        try:
+            return json.loads(repair_json(text, start))
+        except ValueError:
+            continue
+    raise JsonExtractError("no JSON object found in LLM response")
+
+
+def candidate_starts(text: str):
+    """
+    Positions of the first few '{' after any <think> block, starting inside
+    the first code fence if there is one.
+    """
+    think_end = text.rfind("</think>")
+    offset = 0 if think_end == -1 else think_end + len("</think>")
+    fence = text.find("```", offset)
+    positions = []
+    if fence != -1:
+        position = text.find("{", fence)
+        if position != -1:
+            positions.append(position)
+    position = text.find("{", offset)
+    while position != -1 and len(positions) < MAX_ATTEMPTS:
+        if position not in positions:
+            positions.append(position)
+        position = text.find("{", position + 1)
+    return positions
+
+
+def scan_string(text: str, i: int) -> tuple[str, int, bool]:
+    """
+    Read the string literal opening at text[i].
+
+    Returns it as a JSON string, the index after it, and whether it was
+    closed before the text ended.
+    """
+    string, end, closed = scan_string_once(text, i)
+    if not closed:
+        # cut off mid-string, trailing whitespace is the end of the reply not content
+        string, _, _ = scan_string_once(text.rstrip(), i)
+    return string, end, closed
+
+
+def scan_string_once(text: str, i: int) -> tuple[str, int, bool]:
+    quote = text[i]
+    special = STRING_SPECIAL[quote]
+    parts = ['"']
+    j = i + 1
+    n = len(text)
+    while True:
+        match = special.search(text, j)
+        if match is None:
+            parts.append(text[j:])
+            parts.append('"')
+            return "".join(parts), n, False
+        k = match.start()
+        parts.append(text[j:k])
+        c = text[k]
+        if c == quote:
+            parts.append('"')
+            return "".join(parts), k + 1, True
+        if c == "\\":
+            if k + 1 == n:
+                # a lone backslash cut off at the end of the text
+                j = n
+                continue
+            escaped = text[k + 1]
+            if escaped in VALID_ESCAPES:
+                parts.append(c + escaped)
+            elif escaped == "'":
+                parts.append("'")
+            else:
+                # not a JSON escape, keep the backslash as a character
+                parts.append("\\\\" + escaped)
+            j = k + 2
+        else:
+            # a double quote inside a single-quoted string, or a raw control character
+            parts.append(json.dumps(c)[1:-1])
+            j = k + 1
+
+
+def scan_word(text: str, i: int) -> tuple[str, int]:
+    j = i
+    n = len(text)
+    while j < n and text[j] not in DELIMITERS:
+        j += 1
+    return text[i:j], j
+
+
+def is_number(word: str) -> bool:
+    try:
+        float(word)
+    except ValueError:
+        return False
+    return word.lower() not in ("nan", "inf", "-inf", "infinity", "-infinity")
+
+
+def json_number(word: str) -> str:
+    """A number as the model wrote it, rewritten when JSON would reject it (01, +5, 12.)."""
+    try:
+        return str(int(word))
+    except ValueError:
+        return repr(float(word))
+
+
+def next_significant(text: str, i: int) -> str:
+    n = len(text)
+    while i < n and text[i] in " \t\r\n":
+        i += 1
+    return text[i] if i < n else ""
+
+
+def repair_json(text: str, start: int) -> str:
+    """
+    Valid JSON text for the object opening at text[start], as well as it can be recovered.
+
+    Handles single-quoted strings, unquoted keys and bare string values,
+    Python literals, comments, trailing and missing commas, and input that
+    ends (or hits a closing code fence) before the object is complete.
+    """
+    out = []
+    # one entry per open container: [opener, expecting] where expecting is
+    # "key", "colon", "value" or "comma"
+    stack = []
+    i = start
+    n = len(text)
+
+    def begin_value():
+        """
+        Emit the comma (or colon) due before a value or key. Commas are only
+        written here, so trailing commas vanish and missing ones are added.
+        """
+        top = stack[-1] if stack else None
+        if top is None:
+            return
+        if top[1] == "comma":
+            out.append(",")
+            top[1] = "key" if top[0] == "{" else "value"
+        elif top[1] == "colon":
+            out.append(":")
+            top[1] = "value"
+
+    def end_value():
+        if stack:
+            stack[-1][1] = "comma"
+
+    while i < n:
+        c = text[i]
+        if c in " \t\r\n":
+            i += 1
+        elif c in "{[":
+            begin_value()
+            if stack and stack[-1][1] == "key":
+                # an object where a key belongs, the key went missing
+                break
+            out.append(c)
+            stack.append([c, "key" if c == "{" else "value"])
+            i += 1
+        elif c in "}]":
+            if not stack:
+                break
+            opener, expecting = stack.pop()
+            if expecting == "colon":
+                out.append(":null")
+            elif expecting == "value" and opener == "{":
+                out.append("null")
+            out.append(CLOSERS[opener])
+            end_value()
+            i += 1
+            if not stack:
+                return "".join(out)
+        elif c == ",":
+            i += 1
+        elif c == ":":
+            if stack and stack[-1][1] == "colon":
+                out.append(":")
+                stack[-1][1] = "value"
+            i += 1
+        elif c in "\"'":
+            begin_value()
+            string, i, closed = scan_string(text, i)
+            out.append(string)
+            if stack and stack[-1][1] == "key":
+                stack[-1][1] = "colon"
+            else:
+                end_value()
+            if not closed:
+                break
+        elif c == "/" and text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end == -1 else end
+        elif c == "/" and text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+        elif c == "`":
+            # closing code fence before the object ended: the reply was cut short
+            break
+        else:
+            word, j = scan_word(text, i)
+            if not word:
+                i += 1
+                continue
+            begin_value()
+            i = j
+            if stack and stack[-1][1] == "key":
+                if next_significant(text, i) != ":" and not is_number(word):
+                    # prose after an unclosed object
+                    break
+                out.append(json.dumps(word))
+                stack[-1][1] = "colon"
+            elif word in LITERALS:
+                out.append(LITERALS[word])
+                end_value()
+            elif is_number(word):
+                out.append(json_number(word))
+                end_value()
+            else:
+                out.append(json.dumps(word))
+                end_value()
+
+    # the object did not close: finish the open key/value and close every container
+    while stack:
+        opener, expecting = stack.pop()
+        if expecting == "colon":
+            out.append(":null")
+        elif expecting == "value" and opener == "{":
+            out.append("null")
+        out.append(CLOSERS[opener])
+        end_value()
+    return "".join(out)
@@ -0,0 +1,224 @@
+"""
+One shared client for every LLM call.
+
+The Groq SDK client and its pooled httpx connections are created once (at app
+startup, or on first use outside the app) instead of per call. Each model gets
+a concurrency semaphore and a token bucket matching the provider's request
+quota, and rate-limit / server errors are retried with jittered backoff.
+Set LLM_BASE_URL to point everything at a local fake server.
+"""
+
+import json
+import os
+import threading
+import time
+import groq
+import httpx
+from groq import Groq
+from metrics import (
+    get_logger,
+    llm_requests,
+    llm_request_seconds,
+    llm_tokens,
+    llm_rate_limited_seconds,
+    llm_in_flight,
+)
+from upstream import Shared, backoff_delay
+
+# None uses the SDK default (GROQ_BASE_URL or api.groq.com)
+LLM_BASE_URL = os.environ.get("LLM_BASE_URL") or None
+# seconds to wait for a response (or for the next chunk when streaming)
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "10"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))
+# longest wait between attempts, also for a longer Retry-After, since the model's slot is held meanwhile
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "10"))
+# defaults for every model, 0 requests per minute turns rate limiting off
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", "30"))
+# per-model overrides, e.g. {"deepseek-r1-distill-llama-70b": {"concurrency": 2, "requests_per_minute": 30}}
+LLM_MODEL_LIMITS = json.loads(os.environ.get("LLM_MODEL_LIMITS", "{}"))
+
+RETRYABLE_ERRORS = (
+    groq.RateLimitError,
+    groq.InternalServerError,
+    groq.APIConnectionError,
+)
+
+logger = get_logger("llmclient")
+
+
+class TokenBucket:
+    """Allows `rate_per_minute` acquisitions a minute on average, with bursts up to `burst`."""
+
+    def __init__(self, rate_per_minute: float, burst: float):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take a token, blocking until one is available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class ModelLimiter:
+    def __init__(self, concurrency: int, requests_per_minute: float):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.bucket = (
+            TokenBucket(requests_per_minute, max(1, concurrency))
+            if requests_per_minute > 0
+            else None
+        )
+
+
+def count_tokens(model: str, usage):
+    if usage is None:
+        return
+    llm_tokens.labels(model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    llm_tokens.labels(model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+
+class LLMClient:
+    def __init__(self):
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        self.groq = Groq(
+            # a missing key fails on the first call (401), not at startup
+            api_key=os.environ.get("GROQ_API_KEY", ""),
+            base_url=LLM_BASE_URL,
+            http_client=self.http_client,
+            # retries are done here so they also wait for the rate limiter
+            max_retries=0,
+        )
+        self.limiters: dict[str, ModelLimiter] = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "rate_limited_seconds": 0.0,
+            "in_flight": 0,
+        }
+
+    def limiter(self, model: str) -> ModelLimiter:
+        with self.lock:
+            limiter = self.limiters.get(model)
+            if limiter is None:
+                limits = LLM_MODEL_LIMITS.get(model, {})
+                limiter = ModelLimiter(
+                    limits.get("concurrency", LLM_CONCURRENCY),
+                    limits.get("requests_per_minute", LLM_REQUESTS_PER_MINUTE),
+                )
+                self.limiters[model] = limiter
+            return limiter
+
+    def count(self, name: str, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def create(self, limiter: ModelLimiter, **kwargs):
+        """One chat completion request, retried; the caller holds the model's semaphore."""
+        model = kwargs["model"]
+        for attempt in range(1, LLM_MAX_RETRIES + 2):
+            if limiter.bucket is not None:
+                waited = limiter.bucket.acquire()
+                self.count("rate_limited_seconds", waited)
+                llm_rate_limited_seconds.labels(model).inc(waited)
+            self.count("requests")
+            start = time.perf_counter()
+            try:
+                completion = self.groq.chat.completions.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                llm_request_seconds.labels(model).observe(time.perf_counter() - start)
+                if attempt > LLM_MAX_RETRIES:
+                    self.count("failures")
+                    llm_requests.labels(model, "failed").inc()
+                    raise
+                delay = backoff_delay(attempt, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, e)
+                logger.warning(f"LLM request to {model} failed ({e!r}), retrying in {delay:.1f}s")
+                self.count("retries")
+                llm_requests.labels(model, "retried").inc()
+                time.sleep(delay)
+                continue
+            except Exception:
+                llm_request_seconds.labels(model).observe(time.perf_counter() - start)
+                self.count("failures")
+                llm_requests.labels(model, "failed").inc()
+                raise
+            llm_request_seconds.labels(model).observe(time.perf_counter() - start)
+            llm_requests.labels(model, "ok").inc()
+            count_tokens(model, getattr(completion, "usage", None))
+            return completion
+
+    def chat(self, model: str, messages: list, **kwargs):
+        """A chat completion, waiting for a free slot and rate limit token for the model."""
+        limiter = self.limiter(model)
+        with limiter.semaphore:
+            self.count("in_flight")
+            llm_in_flight.labels(model).inc()
+            try:
+                return self.create(limiter, model=model, messages=messages, **kwargs)
+            finally:
+                self.count("in_flight", -1)
+                llm_in_flight.labels(model).dec()
+
+    def stream_chat(self, model: str, messages: list, **kwargs):
+        """
+        Yields the content deltas of a streamed chat completion.
+
+        The model's slot is held until the stream is consumed or closed. Only
+        opening the stream is retried, a failure mid-stream is raised.
+        """
+        limiter = self.limiter(model)
+        with limiter.semaphore:
+            self.count("in_flight")
+            llm_in_flight.labels(model).inc()
+            try:
+                stream = self.create(
+                    limiter, model=model, messages=messages, stream=True, **kwargs
+                )
+                try:
+                    for chunk in stream:
+                        # Groq sends the usage with the last chunk
+                        x_groq = getattr(chunk, "x_groq", None)
+                        count_tokens(model, getattr(x_groq, "usage", None))
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            yield chunk.choices[0].delta.content
+                finally:
+                    stream.close()
+            finally:
+                self.count("in_flight", -1)
+                llm_in_flight.labels(model).dec()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+    def close(self):
+        self.http_client.close()
+
+
+llm_client = Shared(LLMClient)
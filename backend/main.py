@@ -1,34 +1,106 @@
-from models import NewReceipt, Receipt
-from fastapi import FastAPI, Form, File, UploadFile
+import config
+from models import (
+    NewReceipt,
+    Receipt,
+    ReceiptStatus,
+    BatchItemResult,
+    ImageSearchBatch,
+    ImageSearchBatchResult,
+    GeneralInsights,
+    SustainabilityInsights,
+    SustainabilityShare,
+)
+from fastapi import FastAPI, Form, File, UploadFile, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from db import (
-    create_receipt_table,
+    open_pool,
+    close_pool,
+    get_pool_stats,
     list_receipt_records,
     insert_receipt_record,
+    insert_receipt_records,
+    find_receipts_by_image_hash,
+    encode_cursor,
+    decode_cursor,
+    get_spending_by_period,
+    get_spending_by_category,
     get_receipt_record,
+    get_receipt_status,
 )
 from contextlib import asynccontextmanager
 from imagestore import (
+    ImageRejected,
+    ImageTooLarge,
     delete_receipt_image,
     store_receipt_image,
     get_image_location,
+    sniff_file_content_type,
+    get_rendition,
+    negotiate_rendition_format,
+    RENDITION_CONTENT_TYPES,
 )
 from uuid import uuid4
-from datetime import datetime
-from dotenv import load_dotenv
-from receipt_processing import get_receipt_json
-from llmIntegration import generate_recipies_list, generate_recipie_details
-from shutterstocksearch import searchShutterstock
+from typing import Literal
+from datetime import date, datetime
+from email.utils import formatdate, parsedate_to_datetime
+import anyio
+import httpx
+import logging
+from migrations import run_migrations
+from ocrqueue import (
+    start_workers,
+    stop_workers,
+    enqueue_receipt,
+    recover_interrupted_jobs,
+)
+from extraction import get_engine
+from ocrmetrics import ocr_metrics
+from llmIntegration import generate_recipie_details, stream_recipie_details
+from llmclient import llm_client
+from metrics import MetricsMiddleware, span, count_cache, render_metrics
+from recipecache import cached_recipe_suggestions, stop_refreshes
+from findnearbyplaces import (
+    MAX_PAGES,
+    PlacesError,
+    place_search,
+)
+from shutterstocksearch import (
+    CircuitOpen,
+    ImageSearchDisabled,
+    ImageSearchError,
+    image_search,
+)
+
+
+# uvicorn's logger, so these lines are formatted and shown like the server's own
+logger = logging.getLogger("uvicorn.error")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("creating tables")
-    load_dotenv()
-    create_receipt_table()
+    await open_pool()
+    if config.STARTUP_MIGRATIONS:
+        logger.info("running migrations")
+        await run_migrations()
+        await recover_interrupted_jobs()
+    llm_client.open()
+    place_search.open()
+    image_search.open()
+    if not image_search.get().enabled:
+        logger.warning("SHUTTERSTOCK_API_KEY / SHUTTERSTOCK_API_SECRET not set, image search is disabled")
+    await start_workers()
+    logger.info("ready")
     yield
-    print("shutting down")
+    logger.info("shutting down, draining OCR jobs")
+    await stop_workers()
+    await stop_refreshes()
+    await llm_client.close()
+    await place_search.close()
+    await image_search.close()
+    await close_pool()
+    logger.info("shut down")
 
 
 app = FastAPI(lifespan=lifespan)
@@ -41,88 +113,390 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Cache", "X-Request-ID"],
 )
+# outermost, so the time spent in CORS handling is counted too
+app.add_middleware(MetricsMiddleware)
+
 
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
-@app.post("/receipts")
+
+def is_not_modified(request: Request, etag: str | None, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        if etag is None:
+            return False
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+@app.post("/receipts", status_code=202)
 async def create_receipt(
     name: str = Form(...), image: UploadFile = File(...)
 ) -> Receipt:
-    print("posting receipt...")
     key = uuid4().hex
 
-    print("storing image...")
-    await store_receipt_image(key, image)
     try:
-        print("getting json...")
-        j = get_receipt_json(get_image_location(key))
-        # print(j)
-        print("inserting record...")
-        return insert_receipt_record(
-            NewReceipt(name=name, key=key, data=j, timestamp=datetime.now())
+        with span("store_image"):
+            stored_image = await store_receipt_image(key, image)
+    except ImageRejected as e:
+        status_code = 413 if isinstance(e, ImageTooLarge) else 415
+        raise HTTPException(status_code=status_code, detail=str(e))
+    try:
+        with span("db_insert"):
+            receipt = await insert_receipt_record(
+                NewReceipt(
+                    name=name,
+                    key=key,
+                    data={},
+                    timestamp=datetime.now(),
+                    status="pending",
+                    image_hash=stored_image.sha256,
+                    content_type=stored_image.content_type,
+                )
+            )
+    except Exception as e:
+        await delete_receipt_image(key)
+        raise e
+
+    enqueue_receipt(receipt.id, receipt.key, receipt.image_hash)
+    return receipt
+
+
+@app.post("/receipts/batch", status_code=202)
+async def create_receipts_batch(
+    images: list[UploadFile] = File(...), name: str | None = Form(None)
+) -> list[BatchItemResult]:
+    stored = []
+    rejected = {}
+    for image in images:
+        key = uuid4().hex
+        try:
+            with span("store_image"):
+                stored_image = await store_receipt_image(key, image)
+        except ImageRejected as e:
+            rejected[key] = str(e)
+            stored.append((image, key, None))
+            continue
+        stored.append((image, key, stored_image))
+
+    existing = await find_receipts_by_image_hash(
+        [s.sha256 for _, _, s in stored if s is not None]
+    )
+    first_in_batch = {}
+    new_receipts = []
+    for image, key, stored_image in stored:
+        if stored_image is None:
+            continue
+        image_hash = stored_image.sha256
+        if image_hash in existing or image_hash in first_in_batch:
+            await delete_receipt_image(key)
+            continue
+        first_in_batch[image_hash] = key
+        new_receipts.append(
+            NewReceipt(
+                name=name or image.filename or key,
+                key=key,
+                data={},
+                timestamp=datetime.now(),
+                status="pending",
+                image_hash=image_hash,
+                content_type=stored_image.content_type,
+            )
         )
+
+    try:
+        with span("db_insert", receipts=len(new_receipts)):
+            inserted = await insert_receipt_records(new_receipts)
     except Exception as e:
-        delete_receipt_image(key)
+        for receipt in new_receipts:
+            await delete_receipt_image(receipt.key)
         raise e
 
+    # OCR fan-out is bounded by the worker pool (OCR_WORKERS)
+    for receipt in inserted:
+        enqueue_receipt(receipt.id, receipt.key, receipt.image_hash)
+
+    by_hash = existing | {r.image_hash: r for r in inserted}
+    results = []
+    for image, key, stored_image in stored:
+        if stored_image is None:
+            results.append(
+                BatchItemResult(
+                    filename=image.filename, status="rejected", error=rejected[key]
+                )
+            )
+            continue
+        receipt = by_hash[stored_image.sha256]
+        status = "queued" if receipt.key == key else "duplicate"
+        results.append(
+            BatchItemResult(filename=image.filename, status=status, receipt=receipt)
+        )
+    return results
+
 
 @app.get("/receipts")
-def list_receipts() -> list[Receipt]:
-    receipts = list_receipt_records()
-    print(receipts)
+async def list_receipts(
+    response: Response,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    store: str | None = None,
+    name: str | None = None,
+    fields: Literal["full", "summary"] = "full",
+) -> list[Receipt]:
+    """
+    Newest receipts first, one page at a time.
+
+    When more receipts follow, the X-Next-Cursor header holds the cursor for
+    the next page.
+    """
+    if cursor is not None:
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    receipts = await list_receipt_records(
+        limit=limit,
+        cursor=cursor,
+        since=since,
+        until=until,
+        store=store,
+        name=name,
+        fields=fields,
+    )
+    if len(receipts) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(receipts[-1])
     return receipts
 
 
 @app.get("/receipts/{id}")
-def get_receipt(id: str) -> Receipt:
-    receipt = get_receipt_record(id)
+async def get_receipt(id: str) -> Receipt:
+    receipt = await get_receipt_record(id)
+    if receipt is None:
+        raise HTTPException(status_code=404, detail="Receipt not found")
     return receipt
 
 
+@app.get("/receipts/{id}/status")
+async def receipt_status(id: str) -> ReceiptStatus:
+    status = await get_receipt_status(id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    return status
+
+
 @app.get("/receipts/{id}/image")
-def receipt_image(id: str) -> FileResponse:
-    receipt = get_receipt_record(id)
-    return FileResponse(get_image_location(receipt.key))
+async def receipt_image(
+    id: str,
+    request: Request,
+    size: Literal["thumb", "medium", "original"] = "original",
+) -> Response:
+    receipt = await get_receipt_record(id)
+    if receipt is None:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    if size == "original":
+        location = await get_image_location(receipt.key)
+        content_type = receipt.content_type or await run_in_threadpool(
+            sniff_file_content_type, location
+        )
+        etag = f'"{receipt.image_hash}"' if receipt.image_hash else None
+        vary = None
+    else:
+        format = negotiate_rendition_format(request.headers.get("accept"))
+        location = await get_rendition(receipt.key, size, format)
+        content_type = RENDITION_CONTENT_TYPES[format]
+        etag = f'"{receipt.image_hash}-{size}.{format}"' if receipt.image_hash else None
+        vary = "Accept"
+    stat_result = await anyio.Path(location).stat()
+
+    # a key's image never changes, so clients and CDNs may keep it forever
+    headers = {
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+    if etag:
+        headers["ETag"] = etag
+    if vary:
+        headers["Vary"] = vary
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    # FileResponse answers Range / If-Range requests itself
+    return FileResponse(
+        location, headers=headers, media_type=content_type, stat_result=stat_result
+    )
+
+
+@app.get("/stats")
+def stats() -> JSONResponse:
+    return JSONResponse(
+        content={
+            "db_pool": get_pool_stats(),
+            "ocr_cache": get_engine().stats(),
+            "llm": llm_client.stats(),
+            "ocr": ocr_metrics.stats(),
+            "places": place_search.stats(),
+            "images": image_search.stats(),
+        }
+    )
+
+
+@app.get("/metrics")
+def metrics() -> Response:
+    """Prometheus exposition of the counters and histograms in metrics.py."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+def insights_since(months: int) -> date:
+    """First day of the month months - 1 months ago, so months=1 is this month."""
+    today = date.today()
+    month_index = today.year * 12 + today.month - 1 - (months - 1)
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def sustainability_share(spend, healthy, organic, local, sustainable):
+    def share(part):
+        return float(part / spend) if spend else 0.0
+
+    return SustainabilityShare(
+        spend=spend,
+        healthy=share(healthy),
+        organic=share(organic),
+        local=share(local),
+        sustainable=share(sustainable),
+    )
 
 
 @app.get("/insights/general")
-def general_insights() -> str:
-    receipts = list_receipt_records()
-    insights = ""
-    return insights
+async def general_insights(months: int = Query(12, ge=1, le=120)) -> GeneralInsights:
+    """Monthly totals and per-category spend, read from the maintained aggregates."""
+    since = insights_since(months)
+    return GeneralInsights(
+        periods=await get_spending_by_period(since),
+        categories=await get_spending_by_category(since),
+    )
 
 
 @app.get("/insights/sustainability")
-def sustainability_insights() -> str:
-    receipts = list_receipt_records()
-    insights = ""
-    return insights
+async def sustainability_insights(
+    months: int = Query(12, ge=1, le=120),
+) -> SustainabilityInsights:
+    categories = await get_spending_by_category(insights_since(months))
+    return SustainabilityInsights(
+        overall=sustainability_share(
+            sum(c.spend for c in categories),
+            sum(c.healthy_spend for c in categories),
+            sum(c.organic_spend for c in categories),
+            sum(c.local_spend for c in categories),
+            sum(c.sustainable_spend for c in categories),
+        ),
+        categories={
+            c.category: sustainability_share(
+                c.spend,
+                c.healthy_spend,
+                c.organic_spend,
+                c.local_spend,
+                c.sustainable_spend,
+            )
+            for c in categories
+        },
+    )
 
 
 @app.get("/recipes/suggestions")
-def get_recipe_suggestions() -> JSONResponse:
-    receipts = list_receipt_records()
-    receipt_data = [r.data for r in receipts]
-    recipes = generate_recipies_list(receipt_data)
-    return JSONResponse(content=recipes)
+async def get_recipe_suggestions() -> JSONResponse:
+    recipes, cache_status = await cached_recipe_suggestions()
+    count_cache("recipes", cache_status)
+    return JSONResponse(content=recipes, headers={"X-Cache": cache_status})
+
+
+def sse_events(chunks):
+    """Server-sent events for a text stream: one message per chunk, then a done event."""
+    try:
+        for chunk in chunks:
+            # a newline inside data would end the field, so each line gets its own
+            yield "".join(f"data: {line}\n" for line in chunk.split("\n")) + "\n"
+    except Exception:
+        logger.exception("recipe details stream failed")
+        yield "event: error\ndata: \n\n"
+        return
+    yield "event: done\ndata: \n\n"
 
 
 @app.get("/recipes/{recipe_name}/details")
-def get_recipe_details(recipe_name: str, ingredients: str, description: str | None = None) -> JSONResponse:
+def get_recipe_details(request: Request, recipe_name: str, ingredients: str, description: str | None = None) -> Response:
     ingredients_list = ingredients.split(',')
     recipe = {
         "name": recipe_name, 
         "ingredients": ingredients_list,
         "description": description
     }
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            sse_events(stream_recipie_details(recipe)),
+            media_type="text/event-stream",
+            # stop proxies (nginx) from buffering the stream
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     details = generate_recipie_details(recipe)
     return JSONResponse(content={"details": details})
 
 
+@app.get("/places/nearby")
+async def nearby_places(
+    response: Response,
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius: int = Query(1000, ge=1, le=50000),
+    type: str | None = None,
+    keyword: str | None = None,
+    cursor: int = Query(0, ge=0, le=MAX_PAGES - 1),
+) -> list[dict]:
+    """
+    Places near a location, one page (up to 20) at a time.
+
+    When more places follow, the X-Next-Cursor header holds the cursor for
+    the next page.
+    """
+    try:
+        places, next_page = await place_search.get().search(
+            (lat, lng), radius, type, keyword, cursor
+        )
+    except (PlacesError, httpx.HTTPError) as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    if next_page is not None:
+        response.headers["X-Next-Cursor"] = str(next_page)
+    return places
+
+
 @app.get("/images/search/{query}")
-def search_images(query: str) -> JSONResponse:
+async def search_images(query: str) -> JSONResponse:
     try:
-        image_urls = searchShutterstock(query)
+        image_urls = await image_search.get().search(query)
         return JSONResponse(content={"images": image_urls})
-    except Exception as e:
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+    except ImageSearchError as e:
+        status_code = 503 if isinstance(e, (CircuitOpen, ImageSearchDisabled)) else 502
+        return JSONResponse(content={"error": str(e)}, status_code=status_code)
+
+
+@app.post("/images/search")
+async def search_images_batch(batch: ImageSearchBatch) -> ImageSearchBatchResult:
+    """Images for several queries (e.g. every suggested recipe) in one concurrent round."""
+    if not image_search.get().enabled:
+        raise HTTPException(status_code=503, detail="Image search is disabled")
+    images, errors = await image_search.get().search_batch(batch.queries)
+    return ImageSearchBatchResult(images=images, errors=errors)
@@ -0,0 +1,267 @@
+"""
+Prometheus metrics for GET /metrics, and stage timings in structured logs.
+
+The middleware times every request by route template and counts requests in
+flight. Code paths worth watching wrap their steps in span("stage"), which
+feeds the stage histogram and, for spans slower than METRICS_LOG_SPANS_MS,
+writes a JSON log line carrying the request id (or receipt id for OCR jobs)
+so a slow percentile can be traced to the step and the request behind it.
+
+Application log lines go through get_logger(), whose handler adds the same
+fields (level, time, pid, request or receipt id) to every message.
+
+Under serve.py every worker writes its metrics to PROMETHEUS_MULTIPROC_DIR
+and a scrape of any worker returns the sum. DB pool gauges are read from the
+worker answering the scrape and labelled with its pid.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+from db import get_pool_stats
+
+# spans at least this slow are logged, 0 logs every span and -1 none
+METRICS_LOG_SPANS_MS = float(os.environ.get("METRICS_LOG_SPANS_MS", "500"))
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# from a cache hit to an OCR call with retries
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+http_requests = Histogram(
+    "payperless_http_request_duration_seconds",
+    "Time to the end of the response body, by route template",
+    ["method", "route", "status"],
+    buckets=BUCKETS,
+)
+http_in_flight = Gauge(
+    "payperless_http_requests_in_flight", "Requests being served", multiprocess_mode="livesum"
+)
+stage_seconds = Histogram(
+    "payperless_stage_duration_seconds",
+    "Time spent in one step of ingest or OCR",
+    ["stage"],
+    buckets=BUCKETS,
+)
+stage_errors = Counter(
+    "payperless_stage_errors_total", "Steps that raised", ["stage", "error"]
+)
+llm_requests = Counter(
+    "payperless_llm_requests_total",
+    "LLM requests by outcome: ok, retried (failed and retried) or failed",
+    ["model", "outcome"],
+)
+llm_request_seconds = Histogram(
+    "payperless_llm_request_duration_seconds",
+    "Time of one LLM request (to the first chunk when streaming)",
+    ["model"],
+    buckets=BUCKETS,
+)
+llm_tokens = Counter("payperless_llm_tokens_total", "Tokens used", ["model", "kind"])
+llm_rate_limited_seconds = Counter(
+    "payperless_llm_rate_limited_seconds_total",
+    "Time spent waiting for the model's rate limit",
+    ["model"],
+)
+llm_in_flight = Gauge(
+    "payperless_llm_requests_in_flight",
+    "LLM requests holding a model slot",
+    ["model"],
+    multiprocess_mode="livesum",
+)
+cache_requests = Counter(
+    "payperless_cache_requests_total",
+    "Cache lookups by result: hit, miss, stale or coalesced (waited for a running fetch)",
+    ["cache", "result"],
+)
+ocr_jobs_queued = Gauge(
+    "payperless_ocr_jobs_queued", "Receipts waiting for an OCR worker", multiprocess_mode="livesum"
+)
+ocr_jobs_in_flight = Gauge(
+    "payperless_ocr_jobs_in_flight", "Receipts being extracted", multiprocess_mode="livesum"
+)
+
+# the counter names used by the caches' own stats
+CACHE_RESULTS = {
+    "hits": "hit",
+    "memory_hits": "hit",
+    "persistent_hits": "hit",
+    "misses": "miss",
+    "coalesced": "coalesced",
+    "hit": "hit",
+    "miss": "miss",
+    "stale": "stale",
+}
+
+
+def count_cache(cache: str, counter: str):
+    if counter in CACHE_RESULTS:
+        cache_requests.labels(cache, CACHE_RESULTS[counter]).inc()
+
+
+# fields added to every span logged in the current request or job
+log_context: contextvars.ContextVar[dict] = contextvars.ContextVar("log_context", default={})
+
+span_logger = logging.getLogger("payperless.spans")
+span_logger.setLevel(logging.INFO)
+span_logger.propagate = False
+if not span_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    span_logger.addHandler(handler)
+
+
+class LogContextFilter(logging.Filter):
+    """Appends the current request or job fields to the message."""
+
+    def filter(self, record):
+        record.context = "".join(f" {name}={value}" for name, value in log_context.get().items())
+        return True
+
+
+app_logger = logging.getLogger("payperless")
+app_logger.setLevel(logging.INFO)
+app_logger.propagate = False
+if not app_logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.addFilter(LogContextFilter())
+    handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s%(context)s")
+    )
+    app_logger.addHandler(handler)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """A module's logger, under the payperless logger configured above."""
+    return logging.getLogger(f"payperless.{name}")
+
+
+def bind_log_context(**fields) -> contextvars.Token:
+    return log_context.set({**log_context.get(), **fields})
+
+
+def log_span(stage: str, seconds: float, fields: dict):
+    if METRICS_LOG_SPANS_MS < 0 or seconds * 1000 < METRICS_LOG_SPANS_MS:
+        return
+    record = {
+        "ts": round(time.time(), 3),
+        "event": "span",
+        "stage": stage,
+        "ms": round(seconds * 1000, 1),
+        **log_context.get(),
+        **fields,
+    }
+    span_logger.info(json.dumps(record, default=str))
+
+
+def observe_stage(stage: str, seconds: float, **fields):
+    """Record a step timed by the caller."""
+    stage_seconds.labels(stage).observe(seconds)
+    log_span(stage, seconds, fields)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """Time the block as one step: stage histogram, error counter and slow-span log."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        stage_errors.labels(stage, type(e).__name__).inc()
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, **fields)
+
+
+class MetricsMiddleware:
+    """
+    Per-route latency and in-flight requests, plus a request id for the logs.
+
+    A plain ASGI middleware so streamed responses are timed to their last
+    chunk. The id comes from X-Request-ID when the client (or proxy) sent one
+    and is returned in the same header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1") or uuid4().hex
+        token = bind_log_context(request_id=request_id)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", []),
+                        (b"x-request-id", request_id.encode("latin-1")),
+                    ],
+                }
+            await send(message)
+
+        http_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            seconds = time.perf_counter() - start
+            http_in_flight.dec()
+            # set by the router on the shared scope, the template keeps label values few
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            http_requests.labels(scope["method"], path, str(status)).observe(seconds)
+            log_span("request", seconds, {"method": scope["method"], "route": path, "status": status})
+            log_context.reset(token)
+
+
+class PoolCollector:
+    """psycopg pool stats of this process, read at scrape time."""
+
+    def collect(self):
+        pid = str(os.getpid())
+        for name, value in get_pool_stats().items():
+            gauge = GaugeMetricFamily(
+                f"payperless_db_{name}", f"psycopg pool stat {name}", labels=["pid"]
+            )
+            gauge.add_metric([pid], value)
+            yield gauge
+
+
+pool_collector = PoolCollector()
+if not MULTIPROCESS:
+    REGISTRY.register(pool_collector)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """The exposition text and its content type."""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(pool_collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,286 @@
+"""
+Ordered schema migrations for the receipts database.
+
+Each migration runs once, in its own transaction, and is recorded in
+schema_migrations. Early migrations use IF NOT EXISTS so databases created before this
+module existed are brought up to date without errors.
+"""
+
+from db import (
+    db_connection,
+    json_number_sql,
+    json_bool_sql,
+    RECEIPT_TOTAL_SQL,
+    RECEIPT_PERIOD_SQL,
+)
+from metrics import get_logger
+
+logger = get_logger("migrations")
+
+# serialises concurrent run_migrations calls (e.g. several app processes)
+MIGRATIONS_LOCK_ID = 827361
+
+
+def item_number_sql(field: str) -> str:
+    return json_number_sql(f"item->>'{field}'")
+
+
+def item_bool_sql(field: str) -> str:
+    return json_bool_sql(f"item->'{field}'")
+
+
+# set-based version of db.replace_receipt_items for every existing receipt
+BACKFILL_RECEIPT_ITEMS = f"""
+    INSERT INTO receipt_items (receipt_id, position, name, quantity, price, category, sub_category, is_healthy, is_organic, is_local, is_sustainable)
+    SELECT
+        r.id,
+        e.ordinality - 1,
+        NULLIF(item->>'name', ''),
+        {item_number_sql("quantity")},
+        {item_number_sql("price")},
+        NULLIF(item->>'category', ''),
+        NULLIF(item->>'sub_category', ''),
+        COALESCE({item_bool_sql("is_healthy")}, {item_bool_sql("is_heathly")}),
+        {item_bool_sql("is_organic")},
+        {item_bool_sql("is_local")},
+        {item_bool_sql("is_sustainable")}
+    FROM receipts r,
+        jsonb_array_elements(
+            CASE WHEN jsonb_typeof(r.data->'items') = 'array' THEN r.data->'items' ELSE '[]' END
+        ) WITH ORDINALITY AS e(item, ordinality)
+    WHERE r.status = 'done' AND jsonb_typeof(item) = 'object'
+"""
+
+# month of a receipt by upload time, what migration 8 aggregated by
+UPLOAD_PERIOD_SQL = "date_trunc('month', r.datetime)::date"
+
+
+# db.apply_spending_aggregates for every existing receipt at once
+def backfill_spending_by_period(period: str) -> str:
+    return f"""
+    INSERT INTO spending_by_period (period, receipt_count, total_spend)
+    SELECT {period}, count(*), COALESCE(sum({RECEIPT_TOTAL_SQL}), 0)
+    FROM receipts r
+    WHERE r.status = 'done'
+    GROUP BY 1
+"""
+
+
+def backfill_spending_by_category(period: str) -> str:
+    return f"""
+    INSERT INTO spending_by_category (period, category, item_count, spend, healthy_spend, organic_spend, local_spend, sustainable_spend)
+    SELECT
+        {period},
+        COALESCE(lower(i.category), ''),
+        count(*),
+        COALESCE(sum(i.price), 0),
+        COALESCE(sum(i.price) FILTER (WHERE i.is_healthy), 0),
+        COALESCE(sum(i.price) FILTER (WHERE i.is_organic), 0),
+        COALESCE(sum(i.price) FILTER (WHERE i.is_local), 0),
+        COALESCE(sum(i.price) FILTER (WHERE i.is_sustainable), 0)
+    FROM receipt_items i
+    JOIN receipts r ON r.id = i.receipt_id
+    WHERE r.status = 'done'
+    GROUP BY 1, 2
+"""
+
+
+# the OCR date is DD-MM-YYYY once validated, anything else (or an impossible
+# date like 31-02) falls back to the upload month
+RECEIPT_PERIOD_FUNCTION = """
+    CREATE OR REPLACE FUNCTION receipt_period(data JSONB, uploaded TIMESTAMP) RETURNS DATE
+    LANGUAGE plpgsql IMMUTABLE AS $$
+    BEGIN
+        IF data->>'date' ~ '^[0-9]{2}-[0-9]{2}-[0-9]{4}$' THEN
+            RETURN date_trunc('month', to_date(data->>'date', 'DD-MM-YYYY'))::date;
+        END IF;
+        RETURN date_trunc('month', uploaded)::date;
+    EXCEPTION WHEN datetime_field_overflow OR invalid_datetime_format THEN
+        RETURN date_trunc('month', uploaded)::date;
+    END
+    $$"""
+
+
+MIGRATIONS = [
+    (
+        1,
+        "create receipts",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS receipts (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100),
+                key VARCHAR(100),
+                data JSON,
+                datetime TIMESTAMP
+            )""",
+        ],
+    ),
+    (
+        2,
+        "receipt status",
+        [
+            # pending -> processing -> done | failed, rows from before the OCR queue are done
+            "ALTER TABLE receipts ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'done'",
+        ],
+    ),
+    (
+        3,
+        "receipt image hash",
+        [
+            # sha256 of the uploaded image bytes, used to skip duplicate uploads
+            "ALTER TABLE receipts ADD COLUMN IF NOT EXISTS image_hash VARCHAR(64)",
+            "CREATE INDEX IF NOT EXISTS receipts_image_hash_idx ON receipts (image_hash)",
+        ],
+    ),
+    (
+        4,
+        "receipt image content type",
+        [
+            # sniffed MIME type of the stored image, NULL for uploads before it was recorded
+            "ALTER TABLE receipts ADD COLUMN IF NOT EXISTS content_type VARCHAR(50)",
+        ],
+    ),
+    (
+        5,
+        "receipt list indexes",
+        [
+            "CREATE INDEX IF NOT EXISTS receipts_datetime_id_idx ON receipts (datetime DESC, id DESC)",
+            "CREATE INDEX IF NOT EXISTS receipts_store_name_idx ON receipts (lower(data->>'store_name'), datetime DESC, id DESC)",
+            "CREATE INDEX IF NOT EXISTS receipts_name_idx ON receipts (lower(name) text_pattern_ops)",
+        ],
+    ),
+    (
+        6,
+        "receipt data as jsonb",
+        [
+            "ALTER TABLE receipts ALTER COLUMN data TYPE JSONB USING data::jsonb",
+            "CREATE INDEX receipts_data_idx ON receipts USING GIN (data jsonb_path_ops)",
+        ],
+    ),
+    (
+        7,
+        "receipt items",
+        [
+            """
+            CREATE TABLE receipt_items (
+                id BIGSERIAL PRIMARY KEY,
+                receipt_id INTEGER NOT NULL REFERENCES receipts (id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                name TEXT,
+                quantity NUMERIC,
+                price NUMERIC,
+                category TEXT,
+                sub_category TEXT,
+                is_healthy BOOLEAN,
+                is_organic BOOLEAN,
+                is_local BOOLEAN,
+                is_sustainable BOOLEAN
+            )""",
+            "CREATE INDEX receipt_items_receipt_id_idx ON receipt_items (receipt_id)",
+            "CREATE INDEX receipt_items_category_idx ON receipt_items (lower(category))",
+            "CREATE INDEX receipt_items_name_idx ON receipt_items (lower(name))",
+            BACKFILL_RECEIPT_ITEMS,
+        ],
+    ),
+    (
+        8,
+        "spending aggregates",
+        [
+            # one row per month, receipt totals as read by OCR
+            """
+            CREATE TABLE spending_by_period (
+                period DATE PRIMARY KEY,
+                receipt_count INTEGER NOT NULL,
+                total_spend NUMERIC NOT NULL
+            )""",
+            # one row per month and lower-cased item category ('' when unknown)
+            """
+            CREATE TABLE spending_by_category (
+                period DATE NOT NULL,
+                category TEXT NOT NULL,
+                item_count INTEGER NOT NULL,
+                spend NUMERIC NOT NULL,
+                healthy_spend NUMERIC NOT NULL,
+                organic_spend NUMERIC NOT NULL,
+                local_spend NUMERIC NOT NULL,
+                sustainable_spend NUMERIC NOT NULL,
+                PRIMARY KEY (period, category)
+            )""",
+            backfill_spending_by_period(UPLOAD_PERIOD_SQL),
+            backfill_spending_by_category(UPLOAD_PERIOD_SQL),
+        ],
+    ),
+    (
+        9,
+        "recipe suggestions cache",
+        [
+            # LLM recipe lists keyed by a hash of the ingredient set they were made from
+            """
+            CREATE TABLE recipe_suggestions (
+                fingerprint VARCHAR(64) PRIMARY KEY,
+                ingredients JSONB NOT NULL,
+                recipes JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT now()
+            )""",
+            "CREATE INDEX recipe_suggestions_created_at_idx ON recipe_suggestions (created_at DESC)",
+        ],
+    ),
+    (
+        10,
+        "spending by purchase date",
+        [
+            RECEIPT_PERIOD_FUNCTION,
+            "TRUNCATE spending_by_period, spending_by_category",
+            backfill_spending_by_period(RECEIPT_PERIOD_SQL),
+            backfill_spending_by_category(RECEIPT_PERIOD_SQL),
+        ],
+    ),
+    (
+        11,
+        "ocr queue ownership",
+        [
+            # when a process last put a pending receipt on its queue, NULL when none holds it
+            "ALTER TABLE receipts ADD COLUMN queued_at TIMESTAMP DEFAULT now()",
+            # when an OCR worker took the receipt, to find jobs whose process died
+            "ALTER TABLE receipts ADD COLUMN claimed_at TIMESTAMP",
+            "UPDATE receipts SET claimed_at = now() WHERE status = 'processing'",
+            "CREATE INDEX receipts_unfinished_idx ON receipts (id) WHERE status IN ('pending', 'processing')",
+        ],
+    ),
+]
+
+
+@db_connection
+async def run_migrations(conn, cur):
+    await cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    try:
+        await cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )""")
+        await conn.commit()
+        await cur.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in await cur.fetchall()}
+        await conn.commit()
+
+        for version, name, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"applying migration {version}: {name}")
+            async with conn.transaction():
+                for step in steps:
+                    await cur.execute(step)
+                await cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+    finally:
+        # a failed statement outside conn.transaction() leaves the transaction
+        # aborted, the unlock would fail and hide the error while the session
+        # lock stays held on a pooled connection
+        await conn.rollback()
+        await cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+        await conn.commit()
@@ -1,6 +1,14 @@
-from pydantic import BaseModel
-from datetime import datetime
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field, field_validator
+from datetime import date, datetime
 from typing import Any
+from coercion import (
+    to_number,
+    to_bool,
+    to_text,
+    to_date,
+    is_blank,
+    RECEIPT_DATE_FORMAT,
+)
 
 
 class Receipt(BaseModel):
@@ -9,6 +17,9 @@ class Receipt(BaseModel):
     key: str
     data: Any
     timestamp: str
+    status: str = "done"
+    image_hash: str | None = None
+    content_type: str | None = None
 
 
 class NewReceipt(BaseModel):
@@ -16,3 +27,168 @@ class NewReceipt(BaseModel):
     key: str
     data: dict
     timestamp: datetime
+    status: str = "done"
+    image_hash: str | None = None
+    content_type: str | None = None
+
+
+class ReceiptStatus(BaseModel):
+    id: int
+    status: str
+
+
+class StoredImage(BaseModel):
+    sha256: str
+    content_type: str
+    size: int
+
+
+class ImageSearchBatch(BaseModel):
+    queries: list[str] = Field(min_length=1, max_length=50)
+
+
+class ImageSearchBatchResult(BaseModel):
+    # images per query as sent, queries that failed are in errors instead
+    images: dict[str, list[str]]
+    errors: dict[str, str]
+
+
+class BatchItemResult(BaseModel):
+    filename: str | None
+    # queued: new receipt waiting for OCR, duplicate: same image already uploaded,
+    # rejected: not stored (see error)
+    status: str
+    receipt: Receipt | None = None
+    error: str | None = None
+
+
+class PeriodSpend(BaseModel):
+    period: date
+    receipt_count: int
+    total_spend: float
+
+
+class CategorySpend(BaseModel):
+    category: str
+    item_count: int
+    spend: float
+    healthy_spend: float
+    organic_spend: float
+    local_spend: float
+    sustainable_spend: float
+
+
+class GeneralInsights(BaseModel):
+    periods: list[PeriodSpend]
+    categories: list[CategorySpend]
+
+
+class SustainabilityShare(BaseModel):
+    spend: float
+    # fraction of item spend flagged healthy / organic / local / sustainable
+    healthy: float
+    organic: float
+    local: float
+    sustainable: float
+
+
+class SustainabilityInsights(BaseModel):
+    overall: SustainabilityShare
+    categories: dict[str, SustainabilityShare]
+
+
+def coerce_number(value):
+    if is_blank(value):
+        return None
+    number = to_number(value)
+    if number is None:
+        raise ValueError(f"not a number: {value!r}")
+    return int(number) if number == number.to_integral_value() else float(number)
+
+
+def coerce_bool(value):
+    if is_blank(value):
+        return None
+    flag = to_bool(value)
+    if flag is None:
+        raise ValueError(f"not a boolean: {value!r}")
+    return flag
+
+
+def coerce_text(value):
+    if isinstance(value, (dict, list)):
+        raise ValueError("not text")
+    return to_text(value.strip() if isinstance(value, str) else value)
+
+
+class ReceiptItemData(BaseModel):
+    """One item of an OCR result, with the field names the OCR prompt asks for."""
+
+    # keys the model adds beyond the prompt are kept
+    model_config = ConfigDict(extra="allow")
+
+    name: str | None = None
+    quantity: int | float | None = None
+    price: int | float | None = None
+    category: str | None = None
+    sub_category: str | None = None
+    # the OCR prompt spells it is_heathly
+    is_heathly: bool | None = Field(
+        default=None, validation_alias=AliasChoices("is_heathly", "is_healthy")
+    )
+    is_organic: bool | None = None
+    is_local: bool | None = None
+    is_sustainable: bool | None = None
+
+    _numbers = field_validator("quantity", "price", mode="before")(coerce_number)
+    _bools = field_validator(
+        "is_heathly", "is_organic", "is_local", "is_sustainable", mode="before"
+    )(coerce_bool)
+    _texts = field_validator("name", "category", "sub_category", mode="before")(
+        coerce_text
+    )
+
+
+class ReceiptData(BaseModel):
+    """Validated OCR result; dates become DD-MM-YYYY and numeric strings numbers."""
+
+    model_config = ConfigDict(extra="allow")
+
+    date: str | None = None
+    total_amount: int | float | None = None
+    items: list[ReceiptItemData] = []
+    tax: int | float | None = None
+    tip: int | float | None = None
+    store_name: str | None = None
+    address: str | None = None
+    phone_number: str | None = None
+    store_type: str | None = None
+
+    _numbers = field_validator("total_amount", "tax", "tip", mode="before")(
+        coerce_number
+    )
+    _texts = field_validator(
+        "store_name", "address", "phone_number", "store_type", mode="before"
+    )(coerce_text)
+
+    @field_validator("date", mode="before")
+    @classmethod
+    def coerce_date(cls, value):
+        if is_blank(value):
+            return None
+        parsed = to_date(value)
+        if parsed is None:
+            raise ValueError(f"not a date: {value!r}")
+        return parsed.strftime(RECEIPT_DATE_FORMAT)
+
+    @field_validator("items", mode="before")
+    @classmethod
+    def coerce_items(cls, value):
+        if is_blank(value):
+            return []
+        if isinstance(value, dict):
+            value = [value]
+        if not isinstance(value, list):
+            raise ValueError("items is not a list")
+        # stray strings or numbers in the list are not items
+        return [item for item in value if isinstance(item, dict)]
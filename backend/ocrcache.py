@@ -0,0 +1,242 @@
+import json
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from metrics import count_cache
+
+OCR_CACHE_BACKEND = os.environ.get("OCR_CACHE_BACKEND", "sqlite")  # sqlite | memory
+OCR_CACHE_PATH = os.environ.get("OCR_CACHE_PATH", "llm_responses/ocr_cache.sqlite3")
+OCR_CACHE_MEMORY_ENTRIES = int(os.environ.get("OCR_CACHE_MEMORY_ENTRIES", "1024"))
+OCR_CACHE_MAX_ENTRIES = int(os.environ.get("OCR_CACHE_MAX_ENTRIES", "100000"))
+# seconds a result stays valid, 30 days by default
+OCR_CACHE_TTL = float(os.environ.get("OCR_CACHE_TTL", str(30 * 24 * 3600)))
+
+
+class CacheBackend(ABC):
+    """A key -> JSON value store, all methods must be thread safe."""
+
+    @abstractmethod
+    def get(self, key: str):
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value):
+        ...
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+
+class MemoryBackend(CacheBackend):
+    """In-process LRU with a TTL per entry."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SqliteBackend(CacheBackend):
+    """
+    Persistent tier in a single SQLite file.
+
+    Writes are transactional so readers never see half-written results, and
+    WAL mode lets several worker processes share the file.
+    """
+
+    # least recently used rows are trimmed every this many writes
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.writes = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ocr_cache_accessed_idx ON ocr_cache (accessed_at)"
+            )
+
+    def get(self, key):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM ocr_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                self.conn.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                return None
+            self.conn.execute(
+                "UPDATE ocr_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now),
+            )
+            self.writes += 1
+            if self.writes % self.EVICT_EVERY == 0:
+                self.evict(now)
+
+    def evict(self, now: float):
+        self.conn.execute("DELETE FROM ocr_cache WHERE expires_at < ?", (now,))
+        self.conn.execute(
+            """
+            DELETE FROM ocr_cache WHERE key IN (
+                SELECT key FROM ocr_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_entries,),
+        )
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+
+
+class OcrCache:
+    """
+    Memory LRU in front of an optional persistent backend.
+
+    get_or_compute de-duplicates concurrent misses for the same key, so
+    simultaneous uploads of one image only trigger a single LLM call.
+    """
+
+    def __init__(self, memory: MemoryBackend, persistent: CacheBackend | None = None):
+        self.memory = memory
+        self.persistent = persistent
+        self.lock = threading.Lock()
+        self.in_flight: dict[str, Future] = {}
+        self.counters = {
+            "memory_hits": 0,
+            "persistent_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+        }
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+        count_cache("ocr", name)
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            self.count("memory_hits")
+            return value
+        if self.persistent is not None:
+            value = self.persistent.get(key)
+            if value is not None:
+                self.count("persistent_hits")
+                self.memory.set(key, value)
+                return value
+        self.count("misses")
+        return None
+
+    def set(self, key: str, value):
+        self.memory.set(key, value)
+        if self.persistent is not None:
+            self.persistent.set(key, value)
+
+    def get_or_compute(self, key: str, compute):
+        """Cached value for key, else compute() once; empty results are not stored."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+            else:
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            count_cache("ocr", "coalesced")
+            return future.result()
+
+        try:
+            # a previous leader may have finished between our miss and now
+            value = self.memory.get(key)
+            if value is None:
+                value = compute()
+                if value:
+                    self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["memory_hits"] + stats["persistent_hits"] + stats["misses"]
+        hits = stats["memory_hits"] + stats["persistent_hits"]
+        stats["hit_ratio"] = hits / lookups if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        if self.persistent is not None:
+            stats["persistent_entries"] = len(self.persistent)
+        return stats
+
+
+def make_ocr_cache() -> OcrCache:
+    memory = MemoryBackend(OCR_CACHE_MEMORY_ENTRIES, OCR_CACHE_TTL)
+    if OCR_CACHE_BACKEND == "memory":
+        return OcrCache(memory)
+    if OCR_CACHE_BACKEND == "sqlite":
+        return OcrCache(
+            memory,
+            SqliteBackend(OCR_CACHE_PATH, OCR_CACHE_MAX_ENTRIES, OCR_CACHE_TTL),
+        )
+    raise ValueError(f"Unknown OCR_CACHE_BACKEND: {OCR_CACHE_BACKEND}")
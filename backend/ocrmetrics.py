@@ -0,0 +1,98 @@
+import config
+import os
+import threading
+from collections import deque
+
+# latency percentiles are computed over this many of the most recent calls
+OCR_METRICS_WINDOW = int(os.environ.get("OCR_METRICS_WINDOW", "1000"))
+
+
+def percentile(sorted_samples: list[float], fraction: float) -> float:
+    index = min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))
+    return sorted_samples[index]
+
+
+class OcrMetrics:
+    """Thread-safe OCR counters and recent-latency windows, read by GET /stats."""
+
+    def __init__(self, window: int = OCR_METRICS_WINDOW):
+        self.lock = threading.Lock()
+        self.counters = {
+            # vision calls, and those whose reply held no usable JSON
+            "ocr_calls": 0,
+            "ocr_failures": 0,
+            # results with fields that failed validation, and the text-only calls fixing them
+            "invalid_results": 0,
+            "repair_calls": 0,
+            "repair_failures": 0,
+            "fields_repaired": 0,
+            "fields_dropped": 0,
+            # tiered backend: receipts read locally, and why the others went to the vision LLM
+            "local_accepted": 0,
+            "local_low_confidence": 0,
+            "local_incomplete": 0,
+            "local_checksum_failed": 0,
+            "local_errors": 0,
+            # queue jobs, and attempts beyond the first
+            "jobs": 0,
+            "job_retries": 0,
+            "jobs_failed": 0,
+        }
+        self.latencies = {
+            "ocr": deque(maxlen=window),
+            "vision": deque(maxlen=window),
+            "local": deque(maxlen=window),
+            "repair": deque(maxlen=window),
+        }
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name: str, seconds: float):
+        with self.lock:
+            self.latencies[name].append(seconds)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = {name: sorted(samples) for name, samples in self.latencies.items()}
+        stats["retry_rate"] = stats["job_retries"] / stats["jobs"] if stats["jobs"] else 0.0
+        stats["repair_rate"] = (
+            stats["invalid_results"] / stats["ocr_calls"] if stats["ocr_calls"] else 0.0
+        )
+        fallbacks = sum(
+            stats[name]
+            for name in ("local_low_confidence", "local_incomplete", "local_checksum_failed", "local_errors")
+        )
+        routed = stats["local_accepted"] + fallbacks
+        if routed:
+            stats["routing"] = routing_stats(
+                stats["local_accepted"], fallbacks, latencies["vision"], latencies["local"]
+            )
+        for name, samples in latencies.items():
+            if samples:
+                stats[f"{name}_latency_ms"] = {
+                    "count": len(samples),
+                    "p50": round(percentile(samples, 0.50) * 1000, 1),
+                    "p95": round(percentile(samples, 0.95) * 1000, 1),
+                    "p99": round(percentile(samples, 0.99) * 1000, 1),
+                }
+        return stats
+
+
+def routing_stats(accepted: int, fallbacks: int, vision: list[float], local: list[float]) -> dict:
+    """Share of receipts kept local and an estimate of the vision calls, time and money that saved."""
+    stats = {
+        "local_share": accepted / (accepted + fallbacks),
+        "llm_calls_avoided": accepted,
+        "estimated_cost_saved": round(accepted * config.OCR_LLM_CALL_COST, 4),
+    }
+    if vision and local:
+        # a local read replaces a vision call, fallbacks pay for both
+        saved = accepted * percentile(vision, 0.5) - fallbacks * percentile(local, 0.5)
+        stats["estimated_seconds_saved"] = round(saved, 1)
+    return stats
+
+
+ocr_metrics = OcrMetrics()
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import random
+from db import (
+    claim_receipt_record,
+    update_receipt_data,
+    reset_processing_receipt_records,
+    reclaim_receipt_records,
+    release_receipt_records,
+)
+from imagestore import get_image_location
+from ocrmetrics import ocr_metrics
+from metrics import (
+    get_logger,
+    span,
+    bind_log_context,
+    log_context,
+    ocr_jobs_queued,
+    ocr_jobs_in_flight,
+)
+from extraction import get_engine
+from config import OCR_CONCURRENCY
+
+# number of jobs worked on at once, the engine's thread limiter still caps extractions
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(OCR_CONCURRENCY)))
+OCR_MAX_ATTEMPTS = int(os.environ.get("OCR_MAX_ATTEMPTS", "3"))
+# first retry waits about this many seconds, doubling on every further attempt
+OCR_RETRY_BASE_DELAY = float(os.environ.get("OCR_RETRY_BASE_DELAY", "2"))
+# seconds shutdown waits for running jobs, unfinished ones are picked up again on the next start
+OCR_DRAIN_TIMEOUT = float(os.environ.get("OCR_DRAIN_TIMEOUT", "20"))
+# seconds after which a receipt processing without a result (its process died), or pending
+# on a queue nobody works, is taken by another process; keep it above the longest job
+OCR_STALE_AFTER = float(os.environ.get("OCR_STALE_AFTER", "600"))
+# seconds between sweeps for such receipts, the first runs when the workers start
+OCR_RECLAIM_INTERVAL = float(os.environ.get("OCR_RECLAIM_INTERVAL", "30"))
+# a sweep fills the local queue up to this many receipts, so a backlog is shared among processes
+OCR_RECLAIM_BATCH = int(os.environ.get("OCR_RECLAIM_BATCH", "200"))
+
+logger = get_logger("ocrqueue")
+
+queue: asyncio.Queue | None = None
+workers: list[asyncio.Task] = []
+# workers in the middle of a job
+busy: set[asyncio.Task] = set()
+reclaimer_task: asyncio.Task | None = None
+stopping = False
+
+
+def retry_delay(attempt: int) -> float:
+    delay = OCR_RETRY_BASE_DELAY * 2 ** (attempt - 1)
+    return delay + random.uniform(0, delay / 2)
+
+
+async def run_ocr_job(receipt_id: int, key: str, image_hash: str | None):
+    if not await claim_receipt_record(receipt_id):
+        return
+
+    ocr_metrics.count("jobs")
+    for attempt in range(1, OCR_MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            ocr_metrics.count("job_retries")
+        try:
+            with span("ocr", attempt=attempt):
+                data = await get_engine().get_receipt_json_async(
+                    await get_image_location(key), image_hash
+                )
+            if data:
+                with span("db_update"):
+                    await update_receipt_data(receipt_id, data, "done")
+                return
+            logger.warning(f"empty OCR result (attempt {attempt})")
+        except Exception as e:
+            logger.warning(f"OCR failed (attempt {attempt}): {e!r}")
+
+        if attempt < OCR_MAX_ATTEMPTS:
+            await asyncio.sleep(retry_delay(attempt))
+
+    ocr_metrics.count("jobs_failed")
+    logger.error(f"OCR failed after {OCR_MAX_ATTEMPTS} attempts")
+    await update_receipt_data(receipt_id, {}, "failed")
+
+
+async def worker():
+    task = asyncio.current_task()
+    while not stopping:
+        receipt_id, key, image_hash, fields = await queue.get()
+        ocr_jobs_queued.dec()
+        busy.add(task)
+        ocr_jobs_in_flight.inc()
+        # every span logged for this job carries the receipt id and the upload's request id
+        context = bind_log_context(receipt_id=receipt_id, **fields)
+        try:
+            await run_ocr_job(receipt_id, key, image_hash)
+        except Exception:
+            logger.exception("OCR job crashed")
+        finally:
+            log_context.reset(context)
+            busy.discard(task)
+            ocr_jobs_in_flight.dec()
+            queue.task_done()
+
+
+async def recover_interrupted_jobs():
+    """Requeue receipts whose OCR was cut off, before any worker of any process starts."""
+    reset = await reset_processing_receipt_records()
+    if reset:
+        logger.info(f"requeued {reset} interrupted OCR jobs")
+
+
+async def reclaim():
+    """
+    Queue receipts no live queue holds: the backlog after a restart, and the
+    jobs of a worker process that died (see db.reclaim_receipt_records).
+
+    Every process sweeps; each receipt is taken by one of them, so it is
+    queued, and counted in ocr_jobs_queued, once.
+    """
+    while not stopping:
+        room = OCR_RECLAIM_BATCH - queue.qsize()
+        rows = []
+        if room > 0:
+            try:
+                reset, rows = await reclaim_receipt_records(OCR_STALE_AFTER, room)
+                if reset:
+                    logger.warning(f"reclaimed {reset} stale OCR jobs")
+            except Exception:
+                logger.exception("reclaiming OCR jobs failed")
+            for receipt_id, key, image_hash in rows:
+                enqueue_receipt(receipt_id, key, image_hash)
+        if rows and len(rows) == room:
+            # more may be waiting, sweep again as soon as this batch is done
+            try:
+                await asyncio.wait_for(queue.join(), OCR_RECLAIM_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(OCR_RECLAIM_INTERVAL)
+
+
+async def start_workers():
+    global queue, stopping, reclaimer_task
+    queue = asyncio.Queue()
+    stopping = False
+    for _ in range(OCR_WORKERS):
+        workers.append(asyncio.create_task(worker()))
+    reclaimer_task = asyncio.create_task(reclaim())
+
+
+async def stop_workers(drain_timeout: float = OCR_DRAIN_TIMEOUT):
+    """
+    Let running jobs finish (up to drain_timeout seconds) and stop.
+
+    Queued receipts stay pending in the database and are released for the
+    other processes' next sweep. Jobs cancelled at the timeout stay processing
+    until another process reclaims them (OCR_STALE_AFTER) or the next start.
+    """
+    global stopping, reclaimer_task
+    stopping = True
+    if reclaimer_task is not None:
+        reclaimer_task.cancel()
+        await asyncio.gather(reclaimer_task, return_exceptions=True)
+        reclaimer_task = None
+    for task in workers:
+        if task not in busy:
+            task.cancel()
+    running = [task for task in workers if task in busy]
+    if running:
+        logger.info(f"waiting for {len(running)} OCR jobs to finish")
+        _, unfinished = await asyncio.wait(running, timeout=drain_timeout)
+        for task in unfinished:
+            task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+
+    left = []
+    while not queue.empty():
+        left.append(queue.get_nowait()[0])
+    ocr_jobs_queued.dec(len(left))
+    if left:
+        try:
+            await release_receipt_records(left)
+        except Exception:
+            # still pending, taken by a sweep once OCR_STALE_AFTER has passed
+            logger.exception(f"releasing {len(left)} queued OCR jobs failed")
+
+
+def enqueue_receipt(receipt_id: int, key: str, image_hash: str | None = None):
+    queue.put_nowait((receipt_id, key, image_hash, log_context.get()))
+    ocr_jobs_queued.inc()
@@ -0,0 +1,175 @@
+"""
+Turn plain OCR text of a receipt into the receipt JSON the vision model returns.
+
+Used by the local OCR backends. The structure shared by most till receipts is
+relied on: store name at the top, one item per line ending in its price, and
+labelled subtotal / tax / total lines. Chains whose item lines carry product
+codes or tax flags get a StoreLayout, picked from the receipt header.
+"""
+
+import re
+from datetime import datetime
+from coercion import RECEIPT_DATE_FORMAT, to_date
+
+AMOUNT = r"-?\$?\d{1,6}[.,]\d{2}"
+PRICE_LINE = re.compile(rf"^(?P<text>.*?)\s+(?P<price>{AMOUNT})\s*[A-Z]?$")
+QUANTITY_PREFIX = re.compile(r"^(?P<quantity>\d+(?:\.\d+)?)\s*(?:x|@|X)\s+")
+DATE = re.compile(
+    r"\b(\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}-\d{2}-\d{2}"
+    r"|\d{1,2} [A-Za-z]{3,9} \d{4}|[A-Za-z]{3,9} \d{1,2},? \d{4})\b"
+)
+PHONE = re.compile(r"(?<!\d)\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}(?!\d)")
+
+# labelled lines that are not items
+TOTAL_LABEL = re.compile(r"\b(grand\s+)?total\b|\bamount\s+due\b|\bbalance\b", re.I)
+SUBTOTAL_LABEL = re.compile(r"\bsub\s*-?\s*total\b", re.I)
+TAX_LABEL = re.compile(r"\b(sales\s+)?tax\b|\bvat\b|\bgst\b", re.I)
+TIP_LABEL = re.compile(r"\btip\b|\bgratuity\b", re.I)
+PAYMENT_LABEL = re.compile(
+    r"\b(cash|change|visa|mastercard|amex|debit|credit|card|tender|paid|savings|discount)\b",
+    re.I,
+)
+
+# the store is recognised from the first few lines
+HEADER_LINES = 8
+# how US tills print dates, month first; also tried for receipts of no known layout
+US_DATE_FORMATS = ["%m/%d/%y", "%m/%d/%Y", "%m-%d-%y", "%m-%d-%Y"]
+
+
+class StoreLayout:
+    def __init__(
+        self,
+        store_name: str,
+        header: str,
+        item_line: str,
+        store_type="Grocery",
+        date_formats=US_DATE_FORMATS,
+    ):
+        self.store_name = store_name
+        self.header = re.compile(header, re.I)
+        # must have "text" and "price" groups
+        self.item_line = re.compile(item_line)
+        self.store_type = store_type
+        self.date_formats = date_formats
+
+
+def normalize_date(text: str, formats: list[str]) -> str | None:
+    """
+    The date in RECEIPT_DATE_FORMAT: tried with formats first, then as
+    coercion.to_date reads it (day first, ISO, month names). None when
+    unreadable, so the raw text never reaches validation as a wrong date.
+    """
+    for format in formats:
+        try:
+            return datetime.strptime(text, format).strftime(RECEIPT_DATE_FORMAT)
+        except ValueError:
+            pass
+    parsed = to_date(text)
+    return parsed.strftime(RECEIPT_DATE_FORMAT) if parsed else None
+
+
+STORE_LAYOUTS = [
+    # BANANAS 000000004011K 1.14 N
+    StoreLayout(
+        "Walmart",
+        r"wal-?mart|save money\. live better",
+        rf"^(?P<text>.+?)\s+\d{{8,13}}[A-Z]?\s+(?P<price>{AMOUNT})\s*[A-Z]?$",
+    ),
+    # 212000022 GOOD&GATHER MILK NF $3.99
+    StoreLayout(
+        "Target",
+        r"\btarget\b|expect more\. pay less",
+        rf"^\d{{9}}\s+(?P<text>.+?)\s+(?:[A-Z]{{1,2}}\s+)?(?P<price>{AMOUNT})$",
+        store_type="Department Store",
+    ),
+    # E 1234567 KS WATER 4.99 N
+    StoreLayout(
+        "Costco",
+        r"costco|wholesale",
+        rf"^(?:E\s+)?\d{{3,7}}\s+(?P<text>.+?)\s+(?P<price>{AMOUNT})\s*[A-Z]?$",
+        store_type="Warehouse Club",
+    ),
+]
+
+
+def detect_layout(lines: list[str]) -> StoreLayout | None:
+    header = "\n".join(lines[:HEADER_LINES])
+    for layout in STORE_LAYOUTS:
+        if layout.header.search(header):
+            return layout
+    return None
+
+
+def parse_amount(text: str) -> float:
+    return float(text.replace("$", "").replace(",", "."))
+
+
+def parse_receipt_text(text: str) -> dict:
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    receipt = {"items": []}
+    if not lines:
+        return receipt
+
+    layout = detect_layout(lines)
+    if layout is not None:
+        receipt["store_name"] = layout.store_name
+        receipt["store_type"] = layout.store_type
+    else:
+        receipt["store_name"] = lines[0]
+
+    for line in lines:
+        if "date" not in receipt and (match := DATE.search(line)):
+            formats = layout.date_formats if layout is not None else US_DATE_FORMATS
+            if date := normalize_date(match.group(1), formats):
+                receipt["date"] = date
+        if "phone_number" not in receipt and (match := PHONE.search(line)):
+            receipt["phone_number"] = match.group(0)
+
+        match = PRICE_LINE.match(line)
+        if match is None:
+            continue
+        label = match.group("text").strip()
+        amount = parse_amount(match.group("price"))
+        if SUBTOTAL_LABEL.search(label):
+            receipt["subtotal"] = amount
+        elif TAX_LABEL.search(label):
+            receipt["tax"] = amount
+        elif TIP_LABEL.search(label):
+            receipt["tip"] = amount
+        elif TOTAL_LABEL.search(label):
+            # the first total line, later ones are usually tendered amounts
+            receipt.setdefault("total_amount", amount)
+        elif PAYMENT_LABEL.search(label) or "total_amount" in receipt:
+            continue
+        elif label:
+            if layout is not None and (item := layout.item_line.match(line)):
+                label = item.group("text").strip()
+                amount = parse_amount(item.group("price"))
+            quantity = 1
+            if quantity_match := QUANTITY_PREFIX.match(label):
+                quantity = float(quantity_match.group("quantity"))
+                label = label[quantity_match.end() :]
+            receipt["items"].append({"name": label, "quantity": quantity, "price": amount})
+    return receipt
+
+
+def checksum_ok(receipt: dict, tolerance: float) -> bool:
+    """
+    Whether the items add up: to the subtotal when there is one (and subtotal
+    plus tax and tip to the total), else items plus tax and tip to the total.
+    tolerance is relative, with a one cent minimum.
+    """
+    total = receipt.get("total_amount")
+    if total is None or not receipt["items"]:
+        return False
+    extras = receipt.get("tax", 0) + receipt.get("tip", 0)
+    items_sum = sum(item["price"] for item in receipt["items"])
+
+    def close(a: float, b: float) -> bool:
+        return abs(a - b) <= max(0.01, tolerance * abs(b))
+
+    if "subtotal" in receipt:
+        return close(items_sum, receipt["subtotal"]) and close(
+            receipt["subtotal"] + extras, total
+        )
+    return close(items_sum + extras, total)
@@ -0,0 +1,128 @@
+"""
+Recipe suggestions cached per ingredient set.
+
+Suggestions are generated from the distinct items bought recently (perishables
+first) rather than from every receipt, and stored under a fingerprint of that
+ingredient list. A request whose fingerprint has no entry yet is answered with
+the newest stored suggestions while a single background task generates the
+new ones (stale-while-revalidate); only the very first request waits.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from starlette.concurrency import run_in_threadpool
+from db import (
+    list_recent_ingredients,
+    get_recipe_suggestion_record,
+    get_latest_recipe_suggestion_record,
+    save_recipe_suggestion_record,
+)
+from metrics import get_logger
+from llmIntegration import (
+    generate_recipies_for_ingredients,
+    RECIPES_MODEL,
+    RECIPES_PROMPT,
+)
+
+# only items bought within this many days are suggested from
+RECIPE_INGREDIENT_DAYS = int(os.environ.get("RECIPE_INGREDIENT_DAYS", "30"))
+RECIPE_MAX_INGREDIENTS = int(os.environ.get("RECIPE_MAX_INGREDIENTS", "40"))
+# number of ingredient sets whose suggestions are kept
+RECIPE_CACHE_ENTRIES = int(os.environ.get("RECIPE_CACHE_ENTRIES", "20"))
+
+# item categories worth cooking with soon, matched case-insensitively
+PERISHABLE_CATEGORY_PATTERNS = [
+    f"%{c}%"
+    for c in [
+        "produce",
+        "fruit",
+        "vegetable",
+        "dairy",
+        "egg",
+        "meat",
+        "poultry",
+        "seafood",
+        "fish",
+        "bakery",
+        "deli",
+    ]
+]
+
+logger = get_logger("recipecache")
+
+refreshes: dict[str, asyncio.Task] = {}
+
+
+def ingredient_fingerprint(ingredients: list[str]) -> str:
+    """Changes when the ingredient set, the model or the prompt changes."""
+    payload = json.dumps([RECIPES_MODEL, RECIPES_PROMPT, sorted(ingredients)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def recent_ingredients() -> list[str]:
+    """Recent perishable items, or all recent items when none are categorised as perishable."""
+    since = datetime.now() - timedelta(days=RECIPE_INGREDIENT_DAYS)
+    ingredients = await list_recent_ingredients(
+        since, PERISHABLE_CATEGORY_PATTERNS, RECIPE_MAX_INGREDIENTS
+    )
+    if not ingredients:
+        ingredients = await list_recent_ingredients(
+            since, None, RECIPE_MAX_INGREDIENTS
+        )
+    return sorted(ingredients)
+
+
+async def generate_and_store(fingerprint: str, ingredients: list[str]) -> dict:
+    recipes = await run_in_threadpool(generate_recipies_for_ingredients, ingredients)
+    # a failed or unparseable LLM reply is not cached, the next request retries
+    if recipes:
+        await save_recipe_suggestion_record(
+            fingerprint, ingredients, recipes, RECIPE_CACHE_ENTRIES
+        )
+    return recipes
+
+
+def refresh(fingerprint: str, ingredients: list[str]) -> asyncio.Task:
+    """The running generation for this fingerprint, started if there is none."""
+    task = refreshes.get(fingerprint)
+    if task is None:
+        task = asyncio.create_task(generate_and_store(fingerprint, ingredients))
+        refreshes[fingerprint] = task
+        task.add_done_callback(lambda t: finish_refresh(fingerprint, t))
+    return task
+
+
+def finish_refresh(fingerprint: str, task: asyncio.Task):
+    refreshes.pop(fingerprint, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("recipe suggestions refresh failed", exc_info=task.exception())
+
+
+async def cached_recipe_suggestions() -> tuple[dict, str]:
+    """Suggestions for the current ingredients and how they were served: hit, stale or miss."""
+    ingredients = await recent_ingredients()
+    if not ingredients:
+        return {"recipes": []}, "hit"
+
+    fingerprint = ingredient_fingerprint(ingredients)
+    recipes = await get_recipe_suggestion_record(fingerprint)
+    if recipes is not None:
+        return recipes, "hit"
+
+    task = refresh(fingerprint, ingredients)
+    latest = await get_latest_recipe_suggestion_record()
+    if latest is not None:
+        return latest[1], "stale"
+
+    # shielded so a disconnecting client does not cancel the shared generation
+    return await asyncio.shield(task), "miss"
+
+
+async def stop_refreshes():
+    tasks = list(refreshes.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,109 @@
+"""
+Production entrypoint: several uvicorn worker processes on uvloop and httptools.
+
+Migrations and the requeue of OCR jobs cut off by the last shutdown run once
+here, before the workers start, instead of in every worker's startup.
+Workers drain their running OCR jobs when stopped (SIGTERM / Ctrl+C).
+
+    python serve.py [--workers 4] [--port 8000]
+"""
+
+import os
+
+# migrations and the OCR requeue run once in prepare(), not again in the app's
+# startup; set before config reads it, since with --workers 1 uvicorn imports
+# main:app in this process, and inherited by the worker processes otherwise
+os.environ["STARTUP_MIGRATIONS"] = "0"
+
+import config
+import argparse
+import asyncio
+import logging
+import logging.config
+import shutil
+import tempfile
+import uvicorn
+from uvicorn.config import LOGGING_CONFIG
+from migrations import run_migrations
+from ocrqueue import recover_interrupted_jobs
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "8000"))
+# 0 starts one worker per CPU available to this process
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "0"))
+# queued connections the kernel holds while every worker is busy accepting
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", "2048"))
+# seconds an idle keep-alive connection stays open, above the 60s idle timeout of most load balancers
+SERVER_KEEP_ALIVE = int(os.environ.get("SERVER_KEEP_ALIVE", "75"))
+# seconds a stopping worker waits for open requests, then OCR jobs get OCR_DRAIN_TIMEOUT more
+SERVER_GRACEFUL_TIMEOUT = float(os.environ.get("SERVER_GRACEFUL_TIMEOUT", "30"))
+# requests a worker handles before it is replaced, 0 never
+SERVER_MAX_REQUESTS = int(os.environ.get("SERVER_MAX_REQUESTS", "0"))
+# trust X-Forwarded-* from these addresses (the reverse proxy)
+SERVER_FORWARDED_ALLOW_IPS = os.environ.get("SERVER_FORWARDED_ALLOW_IPS", "127.0.0.1")
+# a log line per request, off by default
+SERVER_ACCESS_LOG = os.environ.get("SERVER_ACCESS_LOG", "0") == "1"
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def prepare_metrics_dir():
+    """
+    Workers share metrics through files in PROMETHEUS_MULTIPROC_DIR, a fresh
+    temporary directory unless one is set (its files from an earlier run are removed).
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path is None:
+        path = tempfile.mkdtemp(prefix="payperless-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    return path
+
+
+async def prepare():
+    logger.info("running migrations")
+    await run_migrations()
+    await recover_interrupted_jobs()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with several worker processes")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS or available_cpus())
+    args = parser.parse_args()
+
+    logging.config.dictConfig(LOGGING_CONFIG)
+    asyncio.run(prepare())
+    if args.workers > 1:
+        prepare_metrics_dir()
+
+    logger.info(f"starting {args.workers} workers")
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="uvloop",
+        http="httptools",
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEP_ALIVE,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_TIMEOUT,
+        limit_max_requests=SERVER_MAX_REQUESTS or None,
+        proxy_headers=True,
+        forwarded_allow_ips=SERVER_FORWARDED_ALLOW_IPS,
+        access_log=SERVER_ACCESS_LOG,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,112 +1,241 @@
-import requests
-import base64
-from pprint import pprint
-import json 
-
-
-def search_shutterstock_noapi(query):
-    return
-    query_no_space = query.replace(" ", "-")
-    url = f"https://www.shutterstock.com/_next/data/2f912d81699/en/search/{query_no_space}.json?term={query_no_space}"
-    response = requests.get(url)
-    if response.status_code != 200:
-        raise Exception(f"API request failed: {response.status_code} - {response.text}")
-    data = response.json()
-    for images in data['pageProps']['assets']:
-        # print(images['description'])
-        print(images['url'])
-        print("\n")
-
-def search_shutterstock_images(query, per_page=10, page=1, api_key=None, api_secret=None):
+"""
+Recipe image search (Shutterstock) for /images/search.
+
+One pooled httpx.AsyncClient serves every search. Queries are normalised
+(case, whitespace, punctuation) and their results cached with a TTL and LRU
+eviction, since the same recipe names come back constantly; concurrent
+searches for one query share a request. Failures are retried a bounded number
+of times with jittered backoff, and after repeated failures a circuit breaker
+fails searches immediately until a trial request succeeds again.
+Set SHUTTERSTOCK_BASE_URL to point at a local fake server.
+
+    python -m shutterstocksearch "pineapple pizza" "spinach omelette"
+"""
+
+import config
+import argparse
+import asyncio
+import json
+import re
+import time
+import os
+import httpx
+from upstream import CoalescingCache, Shared, backoff_delay
+
+# image search is disabled (503) unless both are set
+SHUTTERSTOCK_API_KEY = os.environ.get("SHUTTERSTOCK_API_KEY", "")
+SHUTTERSTOCK_API_SECRET = os.environ.get("SHUTTERSTOCK_API_SECRET", "")
+SHUTTERSTOCK_BASE_URL = os.environ.get("SHUTTERSTOCK_BASE_URL", "https://api.shutterstock.com")
+IMAGE_SEARCH_PER_PAGE = int(os.environ.get("IMAGE_SEARCH_PER_PAGE", "5"))
+IMAGE_SEARCH_TIMEOUT = float(os.environ.get("IMAGE_SEARCH_TIMEOUT", "10"))
+IMAGE_SEARCH_MAX_CONNECTIONS = int(os.environ.get("IMAGE_SEARCH_MAX_CONNECTIONS", "10"))
+IMAGE_SEARCH_MAX_RETRIES = int(os.environ.get("IMAGE_SEARCH_MAX_RETRIES", "2"))
+IMAGE_SEARCH_RETRY_BASE_DELAY = float(os.environ.get("IMAGE_SEARCH_RETRY_BASE_DELAY", "0.5"))
+# longest wait before a retry (a longer Retry-After included), every coalesced search waits with it
+IMAGE_SEARCH_RETRY_MAX_DELAY = float(os.environ.get("IMAGE_SEARCH_RETRY_MAX_DELAY", "2"))
+# consecutive failed searches that open the circuit, and seconds before a trial request
+IMAGE_SEARCH_FAILURE_THRESHOLD = int(os.environ.get("IMAGE_SEARCH_FAILURE_THRESHOLD", "5"))
+IMAGE_SEARCH_RESET_TIMEOUT = float(os.environ.get("IMAGE_SEARCH_RESET_TIMEOUT", "30"))
+IMAGE_SEARCH_CACHE_ENTRIES = int(os.environ.get("IMAGE_SEARCH_CACHE_ENTRIES", "1024"))
+# seconds a result stays valid, 1 day by default
+IMAGE_SEARCH_CACHE_TTL = float(os.environ.get("IMAGE_SEARCH_CACHE_TTL", str(24 * 3600)))
+
+SEARCH_PATH = "/v2/images/search"
+
+
+class ImageSearchError(Exception):
+    pass
+
+
+class CircuitOpen(ImageSearchError):
+    pass
+
+
+class ImageSearchDisabled(ImageSearchError):
+    pass
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase words only, so "Spinach-Omelette!" and "spinach  omelette" share a cache entry."""
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class CircuitBreaker:
     """
-    Searches Shutterstock for images matching the given query and returns a list of image metadata.
-    
-    Parameters:
-        query (str): The search query (e.g., "sunset", "mountains").
-        per_page (int): Number of images to return per page.
-        page (int): Page number for pagination.
-        api_key (str): Your Shutterstock API key.
-        api_secret (str): Your Shutterstock API secret.
-    
-    Returns:
-        list: A list of image objects (dictionaries) returned by the API.
+    Closed until failure_threshold searches fail in a row, then open (failing
+    fast) for reset_timeout seconds, then half open: one trial search decides
+    whether it closes again or stays open.
     """
-    if not api_key or not api_secret:
-        raise ValueError("Both API key and API secret must be provided.")
-
-    # Create the credentials string and encode it in base64 for Basic Authentication.
-    credentials = f"{api_key}:{api_secret}"
-    encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
-    
-    headers = {
-        "Authorization": f"Basic {encoded_credentials}"
-    }
-    
-    # Define the API endpoint and parameters.
-    url = "https://api.shutterstock.com/v2/images/search"
-    params = {
-        "query": query,
-        "per_page": per_page,
-        "page": page
-    }
-    
-    # Make the GET request to the Shutterstock API.
-    response = requests.get(url, headers=headers, params=params)
-    
-    if response.status_code != 200:
-        raise Exception(f"API request failed: {response.status_code} - {response.text}")
-    
-    # Parse the JSON response.
-    data = response.json()
-    
-    # The returned JSON typically contains a "data" key that holds the list of images.
-    image_list = data.get("data", [])
-    
-    return image_list
-
-
-def searchShutterstock(searhQuery="pizza"):
-    API_KEY = "IyOvZLGy1GedgTnmqfMEyHVJnYwAkk1b"
-    API_SECRET = "pqiYGAX7kCH38qE6"
-    while True:
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self.trial_running):
+            raise CircuitOpen("Image search is unavailable, try again later")
+        if state == "half_open":
+            self.trial_running = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial_running:
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+            self.trial_running = False
+
+
+class ImageSearch:
+    def __init__(
+        self,
+        api_key: str = SHUTTERSTOCK_API_KEY,
+        api_secret: str = SHUTTERSTOCK_API_SECRET,
+        base_url: str = SHUTTERSTOCK_BASE_URL,
+    ):
+        self.enabled = bool(api_key and api_secret)
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            auth=(api_key, api_secret),
+            timeout=IMAGE_SEARCH_TIMEOUT,
+            limits=httpx.Limits(max_connections=IMAGE_SEARCH_MAX_CONNECTIONS),
+        )
+        self.cache = CoalescingCache("images", IMAGE_SEARCH_CACHE_ENTRIES, IMAGE_SEARCH_CACHE_TTL)
+        self.breaker = CircuitBreaker(IMAGE_SEARCH_FAILURE_THRESHOLD, IMAGE_SEARCH_RESET_TIMEOUT)
+        self.counters = {
+            "upstream_requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "rejected_open_circuit": 0,
+        }
+
+    async def request(self, query: str) -> list[dict]:
+        for attempt in range(IMAGE_SEARCH_MAX_RETRIES + 1):
+            self.counters["upstream_requests"] += 1
+            try:
+                response = await self.client.get(
+                    SEARCH_PATH,
+                    params={"query": query, "per_page": IMAGE_SEARCH_PER_PAGE, "page": 1},
+                )
+                response.raise_for_status()
+                return response.json().get("data", [])
+            except httpx.HTTPError as e:
+                if attempt == IMAGE_SEARCH_MAX_RETRIES or not is_retryable(e):
+                    raise
+                self.counters["retries"] += 1
+                await asyncio.sleep(
+                    backoff_delay(attempt + 1, IMAGE_SEARCH_RETRY_BASE_DELAY, IMAGE_SEARCH_RETRY_MAX_DELAY, e)
+                )
+
+    async def fetch(self, query: str) -> list[str]:
+        try:
+            self.breaker.allow()
+        except CircuitOpen:
+            self.counters["rejected_open_circuit"] += 1
+            raise
         try:
-            images = search_shutterstock_images(query=searhQuery, per_page=5, page=1,
-                                                api_key=API_KEY, api_secret=API_SECRET)
-
-            print(f"Found {len(images)} images:")
-            # with open("shutterstock.json", "w") as f:
-            #     f.write(json.dumps(images, indent=2))
-            # input("Press Enter to continue...")
-            # Print out the title and URL of the preview asset for each image.
-            image_links = []
-            for img in images:
-                title = img.get("description", "No Description")
-                # The preview URL is nested under "assets" (this structure might vary; see the API docs).
-                assets = img.get("assets", {})
-                # print(assets)
-                # for asset in assets:
-                #     print("Asset: ", asset)
-                #     # print(asset)
-                # preview = assets[::-1]
-                # print(len(assets))
-                # print()
-                image_links.append(assets[list(assets.keys())[-1]]['url'])
-                
-            
-                # print(f"Title: {title}\nPreview URL: {preview_url}\n")
-
-            break
-        except Exception as e:
-            print("Error:", e)
-    return image_links
-
-
-
-# Example usage:
+            images = await self.request(query)
+        except (httpx.HTTPError, ValueError) as e:
+            if is_retryable(e):
+                self.breaker.record_failure()
+            else:
+                # a client error (bad query, bad credentials) says nothing about
+                # the API's health, the next search becomes the trial
+                self.breaker.trial_running = False
+            self.counters["failures"] += 1
+            raise ImageSearchError(f"Image search failed: {e}") from e
+        except BaseException:
+            # cancelled, the next search becomes the trial
+            self.breaker.trial_running = False
+            raise
+        self.breaker.record_success()
+        image_urls = []
+        for image in images:
+            # the last asset is the largest preview
+            assets = image.get("assets") or {}
+            if assets:
+                image_urls.append(assets[list(assets)[-1]]["url"])
+        return image_urls
+
+    async def search(self, query: str) -> list[str]:
+        """Image URLs for query, largest preview of each of the first IMAGE_SEARCH_PER_PAGE results."""
+        if not self.enabled:
+            raise ImageSearchDisabled(
+                "Image search is disabled, set SHUTTERSTOCK_API_KEY and SHUTTERSTOCK_API_SECRET"
+            )
+        query = normalize_query(query)
+        if not query:
+            return []
+        return await self.cache.get(query, lambda: self.fetch(query))
+
+    async def search_batch(self, queries: list[str]) -> tuple[dict[str, list[str]], dict[str, str]]:
+        """Images per query, searched concurrently, and the error of each query that failed."""
+        unique = list(dict.fromkeys(queries))
+        results = await asyncio.gather(*(self.search(q) for q in unique), return_exceptions=True)
+        images = {}
+        errors = {}
+        for query, result in zip(unique, results):
+            if isinstance(result, ImageSearchError):
+                errors[query] = str(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                images[query] = result
+        return images, errors
+
+    async def close(self):
+        await self.cache.close()
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        stats = {**self.cache.stats(), **self.counters}
+        stats["enabled"] = self.enabled
+        stats["circuit"] = self.breaker.state
+        stats["circuit_opened"] = self.breaker.times_opened
+        return stats
+
+
+image_search = Shared(ImageSearch)
+
+
+async def run_cli(queries: list[str]):
+    try:
+        images, errors = await image_search.get().search_batch(queries)
+    finally:
+        await image_search.close()
+    print(json.dumps({"images": images, "errors": errors}, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search recipe images")
+    parser.add_argument("queries", nargs="+")
+    asyncio.run(run_cli(parser.parse_args().queries))
+
+
 if __name__ == "__main__":
-    # search_shutterstock_noapi("pineapple pizza")
-    # Replace these with your actual Shutterstock API credentials.
-    print(searchShutterstock("pizza pineapple"))
-    
-    
-    
\ No newline at end of file
+    main()
@@ -0,0 +1,61 @@
+class ThinkFilter:
+    """
+    Drops <think>...</think> reasoning spans from streamed model output.
+
+    feed() takes chunks as they arrive and returns the text that is safe to
+    pass on. A chunk ending in what could be the start of a tag ("<thi") is
+    held back until the next chunk decides it, so tags split across chunks
+    are still recognised. Whitespace right after a closing tag is dropped too.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.thinking = False
+        self.strip_leading = False
+
+    def emit(self, text: str, output: list[str]):
+        if self.strip_leading:
+            text = text.lstrip()
+            if not text:
+                return
+            self.strip_leading = False
+        output.append(text)
+
+    def feed(self, chunk: str) -> str:
+        output = []
+        self.buffer += chunk
+        while True:
+            tag = self.CLOSE_TAG if self.thinking else self.OPEN_TAG
+            index = self.buffer.find(tag)
+            if index == -1:
+                split = len(self.buffer) - partial_tag_length(self.buffer, tag)
+                if not self.thinking:
+                    self.emit(self.buffer[:split], output)
+                self.buffer = self.buffer[split:]
+                return "".join(output)
+
+            if not self.thinking:
+                self.emit(self.buffer[:index], output)
+            self.buffer = self.buffer[index + len(tag) :]
+            self.thinking = not self.thinking
+            if not self.thinking:
+                self.strip_leading = True
+
+    def flush(self) -> str:
+        """Text held back at the end of the stream, an unclosed reasoning span is dropped."""
+        output = []
+        if not self.thinking:
+            self.emit(self.buffer, output)
+        self.buffer = ""
+        return "".join(output)
+
+
+def partial_tag_length(text: str, tag: str) -> int:
+    """Length of the longest proper prefix of tag that text ends with."""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
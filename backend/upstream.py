@@ -0,0 +1,140 @@
+"""
+Pieces shared by the clients of upstream APIs (llmclient, findnearbyplaces,
+shutterstocksearch): retry backoff, an async cache whose concurrent misses
+share one fetch (the asyncio counterpart of OcrCache.get_or_compute), and the
+process-wide instance of each client.
+"""
+
+import asyncio
+import inspect
+import random
+import threading
+from typing import Callable, Generic, TypeVar
+from metrics import count_cache, get_logger
+from ocrcache import MemoryBackend
+
+logger = get_logger("upstream")
+
+T = TypeVar("T")
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, error: Exception | None = None) -> float:
+    """
+    Seconds to wait before retry `attempt` (1 for the first): the Retry-After
+    of error's response when the upstream sent one, else jittered exponential
+    backoff. Never more than max_delay, the wait usually holds a slot or a
+    request other callers are waiting on.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(max_delay, max(0.0, float(response.headers.get("retry-after"))))
+        except (TypeError, ValueError):
+            pass
+    delay = base_delay * 2 ** (attempt - 1)
+    return min(max_delay, delay + random.uniform(0, delay))
+
+
+class CoalescingCache:
+    """
+    TTL + LRU cache in front of an async fetch. Concurrent misses for a key
+    share one task, and only successful results are stored. Lookups are
+    counted under `name` in payperless_cache_requests_total.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float, log_errors: bool = False):
+        self.name = name
+        self.entries = MemoryBackend(max_entries, ttl)
+        self.in_flight: dict[str, asyncio.Task] = {}
+        # log failed fetches, including those nobody waited for (prefetches)
+        self.log_errors = log_errors
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            # lookups that waited for a fetch already running
+            "coalesced": 0,
+        }
+
+    async def run(self, key: str, fetch: Callable):
+        value = await fetch()
+        self.entries.set(key, value)
+        return value
+
+    def start(self, key: str, fetch: Callable) -> asyncio.Task:
+        """The running fetch for key, fetch() started if there is none."""
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self.run(key, fetch))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda t: self.finish(key, t))
+        return task
+
+    def finish(self, key: str, task: asyncio.Task):
+        self.in_flight.pop(key, None)
+        # retrieved here so a fetch whose callers all disconnected does not warn
+        if not task.cancelled() and task.exception() is not None and self.log_errors:
+            logger.warning(f"{self.name} fetch failed: {task.exception()!r}")
+
+    async def get(self, key: str, fetch: Callable, count: bool = True):
+        """Cached value for key, else the result of fetch(), shared with concurrent lookups."""
+        value = self.entries.get(key)
+        if value is not None:
+            if count:
+                self.count("hits")
+            return value
+        if count:
+            self.count("coalesced" if key in self.in_flight else "misses")
+        # shielded so a disconnecting client does not cancel a fetch others share
+        return await asyncio.shield(self.start(key, fetch))
+
+    def count(self, name: str):
+        self.counters[name] += 1
+        count_cache(self.name, name)
+
+    def stats(self) -> dict:
+        stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        stats["entries"] = len(self.entries)
+        stats["in_flight"] = len(self.in_flight)
+        return stats
+
+    async def close(self):
+        tasks = list(self.in_flight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Shared(Generic[T]):
+    """
+    The process-wide instance of a client, opened at app startup or created
+    on first use when the app did not open it (scripts).
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self.factory = factory
+        self.instance: T | None = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            if self.instance is None:
+                self.instance = self.factory()
+
+    async def close(self):
+        with self.lock:
+            instance, self.instance = self.instance, None
+        if instance is not None:
+            closed = instance.close()
+            if inspect.isawaitable(closed):
+                await closed
+
+    def get(self) -> T:
+        if self.instance is None:
+            self.open()
+        return self.instance
+
+    def stats(self) -> dict:
+        instance = self.instance
+        return instance.stats() if instance is not None else {}
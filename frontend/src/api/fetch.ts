@@ -107,3 +107,21 @@ export const searchImages = async (query: string): Promise<ImageSearchResponse>
   }
   throw new Error(data.error || 'Failed to search images');
 };
+
+export interface ImageSearchBatchResponse {
+  images: Record<string, string[]>;
+  errors: Record<string, string>;
+}
+
+export const searchImagesBatch = async (queries: string[]): Promise<ImageSearchBatchResponse> => {
+  const response = await fetch(`${BASE_URL}/images/search`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ queries }),
+  });
+  const data = await response.json();
+  if (response.ok) {
+    return data;
+  }
+  throw new Error(data.detail || 'Failed to search images');
+};